@@ -0,0 +1,66 @@
+"""Micro-benchmark of the HTML -> text backends behind myModules.save_plain_text.
+
+Runs every installed backend over a corpus of saved export_view HTML files
+(*.html in --corpus) and reports time per page and throughput, plus how many
+pages come out different from the bs4 reference.
+
+To build a corpus, save the export_view body of a few pages, e.g.
+    myModules.get_body_export_view(site, page_id, user, token).json()['body']['export_view']['value']
+into <corpus>/<page_id>.html. Without a corpus, --synthetic N generates N
+table-heavy pages plus one with an 11 MB text node.
+"""
+import time
+import argparse
+from pathlib import Path
+import myModules
+
+def synthetic_page(rows):
+    cells = "".join(
+        f"<tr><td class=\"confluenceTd\"><p>Row {r} &amp; item</p></td><td class=\"confluenceTd\">Value&nbsp;{r}</td>"
+        f"<td class=\"confluenceTd\"><span>  spaced   text  </span><br/>line {r}</td></tr>"
+        for r in range(rows)
+    )
+    return (
+        "<h1>Heading</h1><p>Intro paragraph with <a href=\"https://example.com\">a link</a>.</p>"
+        "<p>Before <!-- comment --> after the comment</p><style>.x{}</style>"
+        "<p>Stray end tag bar baz</span>x</p>"
+        f"<div class=\"table-wrap\"><table class=\"confluenceTable\"><tbody>{cells}</tbody></table></div>"
+        "<pre class=\"syntaxhighlighter-pre\">def f():\n    return 1</pre>"
+    )
+
+def large_text_page(size):
+    """A page with one text node over libxml2's 10 MB limit (lxml needs huge_tree for it)."""
+    return f"<pre>{'0123456789abcde ' * (size // 16)}</pre><p>after</p>"
+
+def load_corpus(args):
+    if args.corpus:
+        return [p.read_text(encoding="utf-8", errors="ignore") for p in sorted(Path(args.corpus).glob("*.html"))]
+    return [synthetic_page(50 + (i * 37) % 400) for i in range(args.synthetic)] + [large_text_page(11 * 1024 * 1024)]
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark HTML -> text backends")
+    parser.add_argument("--corpus", type=str, help="Folder with saved export_view *.html files")
+    parser.add_argument("--synthetic", type=int, default=50, help="Number of generated pages when no corpus is given")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per backend, the best one is reported")
+    args = parser.parse_args()
+
+    pages = load_corpus(args)
+    if not pages:
+        print(f"No *.html files found in {args.corpus}")
+        return
+    total_mb = sum(len(p.encode("utf-8")) for p in pages) / 1024 / 1024
+    print(f"{len(pages)} pages, {total_mb:.1f} MB of HTML, backends: {', '.join(myModules.text_backends)}")
+
+    reference = [myModules.html_to_text(p, "bs4") for p in pages]
+    for name in myModules.text_backends:
+        best = None
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            out = [myModules.html_to_text(p, name) for p in pages]
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        mismatches = sum(1 for a, b in zip(out, reference) if a != b)
+        print(f"{name:>10}: {best * 1000 / len(pages):8.2f} ms/page {total_mb / best:8.1f} MB/s   {mismatches} pages differ from bs4")
+
+if __name__ == "__main__":
+    main()
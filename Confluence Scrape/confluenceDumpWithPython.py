@@ -1,4 +1,5 @@
 import os
+import sys
 import argparse
 import myModules
 import re
@@ -39,116 +40,183 @@ def extract_page_id_from_url(url: str) -> int | None:
 parser = argparse.ArgumentParser()
 parser.add_argument(
     "--mode", "-m", dest="mode",
-    choices=["space", "url"],
+    choices=["space", "site", "label", "url"],
     help="Choose a download mode", required=True
 )
 parser.add_argument("--site", "-S", type=str, help="Atlassian Site", required=True)
-parser.add_argument("--space", "-s", type=str, help="Space Key (for 'space' mode)")
+parser.add_argument("--space", "-s", type=str, help="Space Key (for 'space' mode, narrows 'label' mode to one space)")
+parser.add_argument("--spaces", type=str, help="Comma-separated Space Keys (for 'site' mode, defaults to every current global space)")
+parser.add_argument("--label", "-l", type=str, help="Comma-separated labels, pages having any of them are exported (for 'label' mode, --space narrows it to one space)")
 parser.add_argument("--url", type=str, help="Full Confluence URL (for 'url' mode)")
 parser.add_argument("--outdir", "-o", type=str, default="output",
                     help="Folder for export", required=False)
+parser.add_argument("--per-page-body", dest="per_page_body", action="store_true", default=False,
+                    help="Fetch every page body separately instead of with the space listing (for 'space', 'site' and 'label' mode)")
+parser.add_argument("--no-cache", dest="no_cache", action="store_true", default=False,
+                    help="Don't use the on-disk response cache in .cache/http")
+parser.add_argument("--text-backend", dest="text_backend", choices=sorted(myModules.text_backends), default=myModules.text_backend,
+                    help="HTML to text extraction backend (default bs4). lxml and selectolax are much faster but can differ from bs4 on malformed markup, e.g. words joined at stray end tags", required=False)
+parser.add_argument("--json-dir", dest="json_dir", type=str, default=None,
+                    help="Also write the preprocess_docs JSON record of every page into this folder", required=False)
+parser.add_argument("--json-shards", dest="json_shards", action="store_true",
+                    help="Store the --json-dir records in size-capped JSONL shards with an offset index instead of one file per page", required=False)
+parser.add_argument("--concurrency", "-c", type=int, default=myModules.DEFAULT_CONCURRENCY,
+                    help="Pages fetched in parallel (for 'space', 'site' and 'label' mode)", required=False)
+parser.add_argument("--processes", "-P", type=int, default=os.cpu_count(),
+                    help="Processes converting HTML to text in 'space', 'site' and 'label' mode, 0 converts on the fetch threads", required=False)
+parser.add_argument("--resume", action="store_true",
+                    help="Skip the pages a previous 'space', 'site' or 'label' export finished (and that haven't changed since)", required=False)
+parser.add_argument("--sections", type=str, default=None,
+                    help="Also split every page on its h1-h3 headings and write the sections to this JSONL file (for 'space', 'site' and 'label' mode)", required=False)
 # --- All other arguments (html, rst, sphinx, etc.) are removed ---
 
-args = parser.parse_args()
-
-# --- Validation ---
-if args.mode == "url" and not args.url:
-    parser.error("--url <URL> is required when mode is 'url'")
-if args.mode == "space" and not args.space:
-    parser.error("--space <SPACE_KEY> is required when mode is 'space'")
-
-# --------------------------
-# Initialization
-# --------------------------
-atlassian_site = args.site
-user_name = os.environ["atlassianUserEmail"]
-api_token = os.environ["atlassianAPIToken"]
-my_outdir_base = args.outdir # This is just "output" by default
-
-# --- THIS IS THE ONLY FOLDER CREATION ---
-# Ensure the base output directory (e.g., "output") exists
-os.makedirs(my_outdir_base, exist_ok=True)
-# ----------------------------------------
-
-# --------------------------
-# URL MODE
-# --------------------------
-if args.mode == "url":
-    print(f"Exporting a single page from URL...")
-    page_id = extract_page_id_from_url(args.url)
+def run_export(args, user_name, api_token, pages, outdir, journal_name, group_key=None):
+    """Export a stream of listing records, journaling finished pages for --resume."""
+    # finished pages are journaled as they complete, --resume skips them on the next run
+    journal = myModules.ExportJournal(os.path.join(outdir, journal_name), args.resume)
+    pending_pages = journal.pending(pages)
+    try:
+        if args.sections:
+            with open(args.sections, "a" if args.resume else "w", encoding="utf-8") as sections_file:
+                myModules.export_pages(args.site,pending_pages,outdir,user_name,api_token,args.concurrency,args.processes,sections_file,journal,group_key)
+        else:
+            myModules.export_pages(args.site,pending_pages,outdir,user_name,api_token,args.concurrency,args.processes,None,journal,group_key)
+    finally:
+        journal.close()
+    if journal.skipped:
+        print(f"Skipped {journal.skipped} pages already exported by the previous run")
+
+def main():
+    args = parser.parse_args()
+
+    # --- Validation ---
+    if args.mode == "url" and not args.url:
+        parser.error("--url <URL> is required when mode is 'url'")
+    if args.mode == "space" and not args.space:
+        parser.error("--space <SPACE_KEY> is required when mode is 'space'")
+    if args.spaces and args.mode != "site":
+        parser.error("--spaces is only used in 'site' mode")
+    if args.mode == "label" and not args.label:
+        parser.error("--label <LABEL>[,<LABEL>] is required when mode is 'label'")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    if args.processes < 0:
+        parser.error("--processes can't be negative")
+
+    # --------------------------
+    # Initialization
+    # --------------------------
+    atlassian_site = args.site
+    user_name = os.environ["atlassianUserEmail"]
+    api_token = os.environ["atlassianAPIToken"]
+    my_outdir_base = args.outdir # This is just "output" by default
+    myModules.set_text_backend(args.text_backend)
+    if args.json_dir:
+        myModules.set_json_output(args.json_dir, args.json_shards)
+    if not args.no_cache:
+        myModules.enable_response_cache()
+
+    # --- THIS IS THE ONLY FOLDER CREATION ---
+    # Ensure the base output directory (e.g., "output") exists
+    os.makedirs(my_outdir_base, exist_ok=True)
+    # ----------------------------------------
+
+    # --------------------------
+    # URL MODE
+    # --------------------------
+    if args.mode == "url":
+        print(f"Exporting a single page from URL...")
+        page_id = extract_page_id_from_url(args.url)
+
+        if not page_id:
+            print("Could not get Page ID from URL. Exiting.")
+        else:
+            print(f"  |-> Extracted Page ID: {page_id}")
+
+            result = myModules.export_page_by_id(atlassian_site, page_id, my_outdir_base, user_name, api_token)
+            if not result.ok:
+                print(f"  [!] ERROR exporting page {page_id}: {result.error}")
+                sys.exit(1)
+
+        print("Done!")
+
+    # --------------------------
+    # SPACE MODE
+    # --------------------------
+    elif args.mode == 'space':
+        print(f"Exporting a whole space...")
+        space_key = args.space
+
+        space = myModules.resolve_space(atlassian_site,space_key,user_name,api_token)
+        if space is None:
+            print(f"Could not find Space Key '{space_key}' in this site.")
+        else:
+            print("Found space: " + space['key'])
+            space_id = space['id']
+            body_format = None if args.per_page_body else myModules.INLINE_BODY_FORMAT
+            # pages are exported while the listing is still being paginated,
+            # the page tree is recorded on the way for the index/TOC
+            page_tree = myModules.PageTree()
+            all_pages_full = page_tree.collect(myModules.iter_pages_from_space(atlassian_site,space_id,user_name,api_token,body_format,space['key']))
+            run_export(args, user_name, api_token, all_pages_full, my_outdir_base, f".export-journal-{space['key']}.jsonl")
+            page_tree.save(my_outdir_base)
+
+        print("Done!")
+
+    # --------------------------
+    # SITE MODE
+    # --------------------------
+    elif args.mode == 'site':
+        print(f"Exporting several spaces...")
+        # one listing of the spaces for the whole run
+        all_spaces = myModules.get_spaces_all(atlassian_site,user_name,api_token)
+        if args.spaces:
+            # space keys are matched case-insensitively, like resolve_space does in 'space' mode
+            by_key = {space['key'].upper(): space for space in all_spaces}
+            keys = [key.strip() for key in args.spaces.split(",") if key.strip()]
+            for key in keys:
+                if key.upper() not in by_key:
+                    print(f"Could not find Space Key '{key}' in this site, skipping it.")
+            spaces = [by_key[key.upper()] for key in keys if key.upper() in by_key]
+        else:
+            spaces = [space for space in all_spaces if space.get('type') == 'global' and space.get('status', 'current') == 'current']
+        print(f"Exporting {len(spaces)} spaces: {', '.join(space['key'] for space in spaces)}")
+
+        body_format = None if args.per_page_body else myModules.INLINE_BODY_FORMAT
+        # the listings are interleaved into one stream, so every space gets a fair share of the
+        # shared concurrency (and rate limiter) and each one is written to <outdir>/<space key>
+        page_trees = {space['key']: myModules.PageTree() for space in spaces}
+        space_keys = {str(space['id']): space['key'] for space in spaces}
+        listings = [page_trees[space['key']].collect(myModules.iter_pages_from_space(atlassian_site,space['id'],user_name,api_token,body_format,space['key']))
+                    for space in spaces]
+        run_export(args, user_name, api_token, myModules.interleave_pages(listings), my_outdir_base, ".export-journal-site.jsonl",
+                   lambda page: space_keys[str(page['spaceId'])])
+        for key, page_tree in page_trees.items():
+            if page_tree.ids:
+                page_tree.save(os.path.join(my_outdir_base, key))
+
+        print("Done!")
+
+    # --------------------------
+    # LABEL MODE
+    # --------------------------
+    elif args.mode == 'label':
+        labels = [label.strip() for label in args.label.split(",") if label.strip()]
+        print(f"Exporting pages labeled {', '.join(labels)}{' in ' + args.space if args.space else ''}...")
+        body_format = None if args.per_page_body else myModules.INLINE_BODY_FORMAT
+        # the search results stream into the same pipeline as a space listing
+        labeled_pages = myModules.iter_pages_by_label(atlassian_site,labels,user_name,api_token,args.space,body_format)
+        journal_name = f".export-journal-label-{myModules.sanitize_filename('+'.join(sorted(labels)))}.jsonl"
+        run_export(args, user_name, api_token, labeled_pages, my_outdir_base, journal_name)
+
+        print("Done!")
 
-    if not page_id:
-        print("Could not get Page ID from URL. Exiting.")
     else:
-        print(f"  |-> Extracted Page ID: {page_id}")
-        
-        # Get page content
-        my_body_export_view = myModules.get_body_export_view(atlassian_site, page_id, user_name, api_token).json()
-        my_body_export_view_html = my_body_export_view["body"]["export_view"]["value"]
-        my_body_export_view_title = my_body_export_view["title"]
-
-        # --- Pass the FLAT output directory to the module ---
-        # Both 'base' and 'content' are just "output"
-        myModules.dump_html(
-            arg_site=atlassian_site,
-            arg_html=my_body_export_view_html,
-            arg_title=my_body_export_view_title,
-            arg_page_id=page_id,
-            arg_outdir_base=my_outdir_base,    # Passes "output"
-            arg_outdir_content=my_outdir_base, # Passes "output"
-            arg_page_labels=None,
-            arg_page_parent=None,
-            arg_username=user_name,
-            arg_api_token=api_token
-        )
-
-    print("Done!")
+        print("No script mode defined in the command line")
 
-# --------------------------
-# SPACE MODE
-# --------------------------
-elif args.mode == 'space':
-    print(f"Exporting a whole space...")
-    space_key = args.space
-    
-    all_spaces_full = myModules.get_spaces_all(atlassian_site,user_name,api_token)
-    space_id = ""
-    for n in all_spaces_full:
-        if (n['key'].lower() == space_key.lower()):
-            print("Found space: " + n['key'])
-            space_id = n['id']
-            break
-
-    if space_id == "":
-        print(f"Could not find Space Key '{space_key}' in this site.")
-    else:
-        all_pages_full = myModules.get_pages_from_space(atlassian_site,space_id,user_name,api_token)
-        print(f"{len(all_pages_full)} pages to export")
-
-        for p in all_pages_full:
-            # Get page content
-            my_body_export_view = myModules.get_body_export_view(atlassian_site,p['id'],user_name,api_token).json()
-            my_body_export_view_html = my_body_export_view['body']['export_view']['value']
-            my_body_export_view_title = p['title']
-            
-            print(f"\nGetting page {my_body_export_view_title}, {p['id']}")
-
-            # --- Pass the FLAT output directory to the module ---
-            # Both 'base' and 'content' are just "output"
-            myModules.dump_html(
-                arg_site=atlassian_site,
-                arg_html=my_body_export_view_html,
-                arg_title=my_body_export_view_title,
-                arg_page_id=p['id'],
-                arg_outdir_base=my_outdir_base,    # Passes "output"
-                arg_outdir_content=my_outdir_base, # Passes "output"
-                arg_page_labels=None,
-                arg_page_parent=p['parentId'],
-                arg_username=user_name,
-                arg_api_token=api_token
-            )
-
-    print("Done!")
-
-else:
-    print("No script mode defined in the command line")
\ No newline at end of file
+    if myModules.response_cache is not None:
+        print(myModules.response_cache.summary())
+
+# the guard keeps worker processes (spawned on Windows) from running the export again
+if __name__ == '__main__':
+    main()
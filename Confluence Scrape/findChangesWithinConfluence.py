@@ -1,93 +1,217 @@
-import requests, json
+import json
 import os
 import sys
-import subprocess
 import concurrent.futures
+import itertools
+import myModules
+from datetime import datetime, timedelta, timezone
 from group import group
-from preprocess_docs import process_all_files
-from requests.auth import HTTPBasicAuth
 from dotenv import load_dotenv
 
 load_dotenv()
 
 opswat_link = "https://opswat.atlassian.net/wiki"
-
-def getAllChanges():
-    host = "https://opswat.atlassian.net"
+space_key = "OES"
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# page id -> last exported version, plus the time of the last successful sync
+MANIFEST_PATH = os.path.join(script_dir, "sync_manifest.json")
+# CQL dates are read in the account's timezone, so look back a bit further than the
+# high-water mark; pages whose version didn't move are skipped anyway
+SYNC_OVERLAP = timedelta(days=1)
+OUTPUT_DIR = "output"
+PROCESSED_DIR = r"C:\chatbot-sdk-implementations\Confluence Scrape\processed confluence files"
+# one JSON line per page that left the space, for the index to drop
+TOMBSTONES_PATH = os.path.join(PROCESSED_DIR, "tombstones.jsonl")
+MAX_CONCURRENT_DOWNLOADS = 20
+
+def loadManifest(path):
+    manifest = myModules.load_json_file(path, {})
+    manifest.setdefault("high_water_mark", None)
+    manifest.setdefault("pages", {})
+    return manifest
+
+def saveManifest(path, manifest):
+    myModules.save_json_file(path, manifest)
+
+def isChanged(manifest, data):
+    """True when a search result's version is newer than the one last exported."""
+    exported = manifest["pages"].get(str(data["id"]))
+    return exported is None or data["version"]["number"] > exported["version"]
+
+def getAllChanges(since=None):
+    """Yield the pages and blogposts changed since the last sync, page by page of the search."""
     user_name = os.environ["atlassianUserEmail"]
     api_key = os.environ["atlassianAPIToken"]
 
-    #Use this url to filter changes the last 10 days, with limit of up to 500 changes
-    url = f"{host}/wiki/rest/api/content/search?cql=type%20in%20(page,blogpost)%20AND%20space%20%3D%20\"OES\"%20AND%20lastmodified%20%3E%20now(\"-10d\")%20order%20by%20lastmodified%20desc&limit=500"
+    # Changes since the last successful sync, or the last 10 days on the first run
+    if since:
+        window = f'lastmodified > "{(since - SYNC_OVERLAP).strftime("%Y-%m-%d %H:%M")}"'
+    else:
+        window = 'lastmodified > now("-10d")'
+    cql = f'type in (page,blogpost) AND space = "{space_key}" AND {window} order by lastmodified desc'
+
+    # only the version is expanded, id and _links.webui are always part of the result
+    yield from myModules.iter_cql_search("opswat", cql, user_name, api_key, arg_expand="version")
+
+def listLivePages(user_name, api_key):
+    """Map the id of every current page and blogpost of the space to its listing record (no bodies)."""
+    space = myModules.resolve_space("opswat", space_key, user_name, api_key)
+    if space is None:
+        raise RuntimeError(f"space {space_key} not found")
+    live = {}
+    for data in myModules.iter_pages_from_space("opswat", space["id"], user_name, api_key):
+        live[str(data["id"])] = data
+    for data in myModules.iter_blogposts_from_space("opswat", space["id"], user_name, api_key):
+        live[str(data["id"])] = data
+    return live
+
+def findRemovals(manifest, live):
+    """Compare the manifest with the live listing.
+
+    Returns (page id, manifest entry, reason) for every exported page that is
+    gone from the space ("deleted": deleted, archived or moved to another
+    space) or whose title changed ("renamed": its files are under the old title).
+    """
+    removals = []
+    for page_id, entry in manifest["pages"].items():
+        data = live.get(page_id)
+        if data is None:
+            removals.append((page_id, entry, "deleted"))
+        elif entry.get("title") and data["title"] != entry["title"]:
+            removals.append((page_id, entry, "renamed"))
+    return removals
+
+def removeOutputs(title):
+    """Delete the .txt and JSON record exported for a page title, returns the paths removed."""
+    name = myModules.sanitize_filename(title)
+    paths = [
+        os.path.join(OUTPUT_DIR, name + ".txt"),
+        os.path.join(PROCESSED_DIR, name + ".json"),
+        # group() takes the folder from the whole file name, so a title without "_" gets "<name>.json/"
+        os.path.join(PROCESSED_DIR, "Grouped_JSONs", (name + ".json").split("_")[0], name + ".json"),
+    ]
+    removed = []
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+def writeTombstones(manifest, removals):
+    """Drop removed pages from the output and the manifest and append their tombstones."""
+    detected_at = datetime.now(timezone.utc).isoformat()
+    os.makedirs(os.path.dirname(TOMBSTONES_PATH), exist_ok=True)
+    with open(TOMBSTONES_PATH, "a", encoding="utf-8") as f:
+        for page_id, entry, reason in removals:
+            removed = removeOutputs(entry["title"]) if entry.get("title") else []
+            f.write(json.dumps({
+                "_id": f"Confluence:{page_id}",
+                "doc_id": page_id,
+                "deleted": True,
+                "reason": reason,
+                "title": entry.get("title"),
+                "last_version": entry.get("version"),
+                "detected_at": detected_at,
+            }, ensure_ascii=False) + "\n")
+            print(f"[{reason.upper()}] {entry.get('title')} ({page_id}), removed {len(removed)} files")
+            if reason == "deleted":
+                del manifest["pages"][page_id]
+            else:
+                # exported again under the new title, even if its version didn't move
+                manifest["pages"][page_id]["version"] = 0
+
+def exportChangedPage(data, user_name, api_key):
+    """Export one search result in-process, returns a myModules.ExportResult."""
+    return myModules.export_page_by_id(
+        "opswat", data["id"], OUTPUT_DIR, user_name, api_key, data["version"]["number"]
+    )
 
-    auth = HTTPBasicAuth(user_name, api_key)
+def recordResult(manifest, result, data):
+    """Print an ExportResult and note it in the manifest, returns 1 if it failed."""
+    url = opswat_link + data["_links"]["webui"]
+    if not result.ok:
+        print(f"[FAILED] {url} | Error: {result.error}")
+        return 1
+    print(f"[SUCCESS] {url} ({result.seconds:.2f}s)")
+    manifest["pages"][str(data["id"])] = {
+        "version": result.version,
+        "title": result.title,
+        "exported_at": datetime.now(timezone.utc).isoformat(),
+    }
+    return 0
 
-    headers = {"Accept" : "application/json"}
-    response = requests.request("GET", url, headers = headers, auth  =auth)
+if __name__ == '__main__':
+    manifest = loadManifest(MANIFEST_PATH)
+    sync_started = datetime.now(timezone.utc)
+    since = datetime.fromisoformat(manifest["high_water_mark"]) if manifest["high_water_mark"] else None
 
-    data = response.json()
-    return data
+    user_name = os.environ["atlassianUserEmail"]
+    api_key = os.environ["atlassianAPIToken"]
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    myModules.enable_response_cache()
 
-def runDownloadScript(url, python_exe, dump_script_path):
-    command_list = [
-        python_exe, 
-        dump_script_path, 
-        "--site", "opswat", 
-        "--mode", "url", 
-        "--url", url,
-    ]
-    
+    # pages deleted, archived, moved away or renamed since the last sync don't show up in the
+    # CQL delta, so the manifest is compared with a cheap id+version listing of the space.
+    # This runs before the export so pages created meanwhile aren't in the manifest yet.
+    renamed = []
     try:
-        result = subprocess.run(
-            command_list, 
-            check=True, 
-            capture_output=True, 
-            text=True, 
-            encoding='utf-8'
-        )
-        # If successful, return the URL
-        return f"[SUCCESS] {url}"
-    except subprocess.CalledProcessError as e:
-        # If it fails, return the error
-        return f"[FAILED] {url} | Error: {e.stderr[:150]}..." # Show first 150 chars of error
-    except FileNotFoundError:
-        return f"[FAILED] {url} | Error: 'python' or 'confluenceDumpWithPython.py' not found."
+        live = listLivePages(user_name, api_key)
     except Exception as e:
-        return f"[FAILED] {url} | Error: {str(e)}"
-
-if __name__ == '__main__':
-    response = getAllChanges()
-    urls =[]
-    results_list = response.get("results")
-    
-    if not results_list:
-        print("No changes made for the past 10 days, pausing the program")
-        sys.exit()
-    
-    for data in results_list:
-        urls.append(opswat_link + data["_links"]["webui"])
-    
-    script_dir = os.path.dirname(os.path.abspath(__file__))
-    dump_script_path = os.path.join(script_dir, "confluenceDumpWithPython.py")
-    python_exe = sys.executable
-
-    MAX_CONCURRENT_DOWNLOADS = 20
-
+        print(f"[FAILED] Could not list the space, skipping deleted page detection | Error: {e}")
+    else:
+        removals = findRemovals(manifest, live)
+        if removals:
+            writeTombstones(manifest, removals)
+        # listing records have id, version and _links.webui like the search results
+        renamed = [live[page_id] for page_id, _, reason in removals if reason == "renamed"]
+        print(f"{len(live)} pages in the space, {len(removals)} removed or renamed since the last sync")
+    # JSON records are written as each page is exported, no separate process_all_files pass
+    myModules.set_json_output(PROCESSED_DIR)
+
+    # pages are exported in this process while the search is still paginating,
+    # all workers share myModules' pooled session and rate limiter
+    modified = 0
+    submitted = 0
+    failed = 0
+    search_complete = True
+    pending = {}
+    seen = set()
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_DOWNLOADS) as executor:
-        futures = {
-            executor.submit(runDownloadScript, url, python_exe, dump_script_path): url for url in urls
-        }
-
-        for future in concurrent.futures.as_completed(futures):
-            result = future.result()
-            print(result) # Print the "[SUCCESS]..." or "[FAILED]..." message
-
+        try:
+            for data in itertools.chain(getAllChanges(since), renamed):
+                if str(data["id"]) in seen:
+                    continue
+                seen.add(str(data["id"]))
+                modified += 1
+                if not isChanged(manifest, data):
+                    continue
+                submitted += 1
+                pending[executor.submit(exportChangedPage, data, user_name, api_key)] = data
+                for future in [f for f in pending if f.done()]:
+                    failed += recordResult(manifest, future.result(), pending.pop(future))
+        except Exception as e:
+            search_complete = False
+            print(f"[FAILED] CQL search stopped after {modified} results | Error: {e}")
+
+        for future in concurrent.futures.as_completed(pending):
+            failed += recordResult(manifest, future.result(), pending[future])
+
+    print(f"{modified} pages modified since {manifest['high_water_mark'] or 'the past 10 days'}, {modified - submitted} already exported at their current version")
+
+    # only move the high-water mark when nothing failed and the search got to the end,
+    # so those pages are picked up next run
+    if failed == 0 and search_complete:
+        manifest["high_water_mark"] = sync_started.isoformat()
+    else:
+        print(f"{failed} pages failed{'' if search_complete else ', search did not complete'}, keeping the previous high-water mark")
+    saveManifest(MANIFEST_PATH, manifest)
+
+    if submitted == 0:
+        print("No changes to export, pausing the program")
+        sys.exit()
 
-    process_all_files(
-    r"C:\chatbot-sdk-implementations\Confluence Scrape\output",
-    r"C:\chatbot-sdk-implementations\Confluence Scrape\processed confluence files"
-    )
-    group(r"C:\chatbot-sdk-implementations\Confluence Scrape\processed confluence files")
+    group(PROCESSED_DIR)
 
 
 
@@ -2,6 +2,7 @@ import os.path
 import json
 import myModules
 import argparse
+import concurrent.futures
 
 user_name = os.environ["atlassianUserEmail"]
 api_token = os.environ["atlassianAPIToken"]
@@ -13,84 +14,66 @@ parser.add_argument('--space', '-s', type=str,
                     help='Space Key')
 parser.add_argument('--page', '-p', type=int,
                     help='Page ID')
+parser.add_argument('--concurrency', '-c', type=int, default=myModules.DEFAULT_CONCURRENCY,
+                    help='Pages checked in parallel (for --space)')
 args = parser.parse_args()
 atlassian_site = args.site
 
 if args.page:
     page_editor_version = myModules.get_editor_version(atlassian_site,args.page,user_name,api_token).json()
-    try:
-        page_editor_version['metadata']['properties']['editor']['value'] == "v2"
-    except KeyError:
-        editor_version = "v1"
-    else:
-        editor_version = "v2"
+    editor_version = myModules.editor_version_from(page_editor_version)
     print(f"Page: {args.page} using Editor: {editor_version}")
 elif args.space:
     space_key = args.space
-    ## get all spaces in order to find the space ID based on the key
-    all_spaces_full = myModules.get_spaces_all(atlassian_site,user_name,api_token)         # get a dump of all spaces
-    all_spaces_short = []                                                             # initialize list for less detailed list of spaces
-    i = 0
-    for n in all_spaces_full:
-        i = i +1
-        all_spaces_short.append({                                                     # append the list of spaces
-            'space_key' : n['key'],
-            'space_id' : n['id'],
-            'space_name' : n['name'],
-            'homepage_id' : n['homepageId'],
-            'spaceDescription' : n['description'],
-            })
-        if (n['key'] == space_key) or n['key'] == str.upper(space_key) or n['key'] == str.lower(space_key):
-            print("Found space: " + n['key'])
-            space_id = n['id']
-            space_name = n['name']
-            current_parent = n['homepageId']
+    ## find the space ID based on the key
+    space = myModules.resolve_space(atlassian_site,space_key,user_name,api_token)
+
+    def check_page(n):
+        """Get the editor version of one page from the listing, errors are recorded rather than raised."""
+        my_page = {
+            'page_id' : n['id'],
+            'pageTitle' : n['title'],
+            'parentId' : n.get('parentId'),
+            'space_id' : n.get('spaceId'),
+            }
+        try:
+            response = myModules.get_editor_version(atlassian_site,n['id'],user_name,api_token)
+            response.raise_for_status()
+            my_page.update({"editor_version" : myModules.editor_version_from(response.json())})
+        except Exception as e:
+            my_page.update({"error" : f"{type(e).__name__}: {e}"})
+        return(my_page)
 
-    if space_key == "" or space_key is None:    # if the supplied space key can't be found
+    if space is None:    # if the supplied space key can't be found
         print("Could not find Space Key in this site")
     else:
+        print("Found space: " + space['key'])
         #
-        # get list of pages from space
+        # go through all pages of the space, one JSON line per page as results come in
         #
-        all_pages_full = myModules.get_pages_from_space(atlassian_site,space_id,user_name,api_token)
-        all_pages_short = []
-        i = 0
-        for n in all_pages_full:
-            i = i + 1
-            all_pages_short.append({
-                'page_id' : n['id'],
-                'pageTitle' : n['title'],
-                'parentId' : n['parentId'],
-                'space_id' : n['spaceId'],
-                }
-            )
-    # go through all pages and update short dict
-    count_v1 = 0
-    count_v2 = 0
-    for my_page in all_pages_short:
-        try:
-            print(f"Checking page {my_page['pageTitle']} ({my_page['page_id']})")
-            page_editor_version = myModules.get_editor_version(atlassian_site,my_page['page_id'],user_name,api_token).json()
-        except KeyError:
-            print(f"Key Error with {my_page}")
-            break
-        else:
-            print(f"OK with {my_page['page_id']}")
+        counts = {"v1": 0, "v2": 0, "error": 0}
+        json_file_name = f"{space_key}.jsonl"
+        with open(json_file_name,'wt',encoding='utf-8') as file, concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+            def write_done(futures):
+                for future in futures:
+                    my_page = future.result()
+                    if "error" in my_page:
+                        counts["error"] += 1
+                        print(f"Error with {my_page['pageTitle']} ({my_page['page_id']}): {my_page['error']}")
+                    else:
+                        counts[my_page["editor_version"]] += 1
+                        print(f"OK with {my_page['page_id']}: {my_page['editor_version']}")
+                    file.write(json.dumps(my_page, ensure_ascii=False) + "\n")
+                file.flush()
 
-        try:
-            page_editor_version['metadata']['properties']['editor']['value'] == "v2"
-        except KeyError:
-            editor_version = "v1"
-            my_page.update({"editor_version" : editor_version})
-            count_v1 = count_v1 + 1
-        else:
-            editor_version = "v2"
-            my_page.update({"editor_version" : editor_version})
-            count_v2 = count_v2 + 1
+            pending = set()
+            for n in myModules.iter_pages_from_space(atlassian_site,space['id'],user_name,api_token):
+                pending.add(executor.submit(check_page, n))
+                if len(pending) >= args.concurrency * 2:      # don't queue the whole space
+                    done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    write_done(done)
+            write_done(concurrent.futures.as_completed(pending))
 
-    json_file_name = f"{space_key}.json"
-    with open(json_file_name,'wt') as file:
-        file.write(str(all_pages_short))
-    print(f"Created the file {json_file_name}, {count_v1}/{count_v2} (v1/v2) pages")
+        print(f"Created the file {json_file_name}, {counts['v1']}/{counts['v2']} (v1/v2) pages, {counts['error']} errors")
 else:
     print(f"No space or page supplied.")
\ No newline at end of file
@@ -2,12 +2,25 @@ import shutil
 import requests
 import os.path
 import json
+import time
+import hashlib
+import asyncio
+import threading
+from array import array
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse, parse_qs, quote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from requests.auth import HTTPBasicAuth
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from bs4 import BeautifulSoup as bs
 import sys
 import pypandoc
 from PIL import Image
 import re
+import preprocess_docs
 
 """
 Arguments needed to run these functions centrally:
@@ -28,25 +41,552 @@ script_dir = os.path.dirname(os.path.abspath(__file__))
 attach_dir = "_images/"
 emoticons_dir = "_images/"
 styles_dir = "_static/"
+cache_dir = os.path.join(script_dir, ".cache")     # persisted lookups shared between runs
 
-def save_plain_text(html_content, output_filepath):
+#
+# HTTP defaults shared by every Confluence call
+#
+DEFAULT_TIMEOUT = 30            # seconds, used when a call doesn't pass its own timeout
+DEFAULT_POOL_SIZE = 20          # keep-alive connections per host, matches MAX_CONCURRENT_DOWNLOADS
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1             # seconds, doubled on every retry by urllib3
+DEFAULT_CONCURRENCY = 8         # pages exported in parallel by the export engine
+PROGRESS_EVERY = 100            # pages of a group between progress lines of export_pages_async
+INLINE_BODY_FORMAT = "export_view"  # body expanded in the space listing (v1 CQL search)
+CQL_PAGE_SIZE = 100             # results per CQL search call
+PAGE_ID_BATCH = 250             # page ids per v2 /pages?id= call
+ATTACHMENT_CONCURRENCY = 4      # attachments of one page downloaded in parallel
+ATTACHMENT_CHUNK_SIZE = 1024 * 1024     # bytes written per chunk while streaming
+ATTACHMENT_ATTEMPTS = 3         # tries per attachment, each one resumes where the last stopped
+SPACE_CACHE_TTL = 7 * 24 * 3600     # seconds a cached space key -> id mapping stays valid
+RESPONSE_CACHE_MAX_BYTES = 512 * 1024 * 1024    # on-disk response cache size before LRU eviction
+RESPONSE_CACHE_MAX_ENTRY_BYTES = 10 * 1024 * 1024   # bigger responses (attachments) aren't cached
+
+#
+# Rate limiting shared by every Confluence call in the process
+#
+THROTTLE_STATUSES = (429, 503)  # responses that mean "slow down"
+THROTTLE_RETRIES = 5            # attempts after a throttled response before giving up on a call
+RATE_INITIAL = 10.0             # requests/second to start with
+RATE_MIN = 0.5
+RATE_MAX = 100.0
+RATE_BURST = 10                 # tokens the bucket can hold
+RATE_DECREASE = 0.5             # multiplicative decrease on 429/503
+RATE_NEAR_LIMIT_DECREASE = 0.9  # gentler decrease when Confluence says we are close to the limit
+RATE_INCREASE = 1.0             # additive increase, ~requests/second gained per second of healthy responses
+
+def parse_retry_after(arg_value):
+    """Return the number of seconds to wait from a Retry-After/X-RateLimit-Reset header, or None.
+
+    Accepts delta-seconds, an HTTP date or an ISO 8601 timestamp.
     """
-    Extracts plain text from an HTML string using BeautifulSoup
-    and saves it to a file.
+    if not arg_value:
+        return(None)
+    try:
+        return(max(0.0, float(arg_value)))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(arg_value)
+    except (TypeError, ValueError):
+        try:
+            retry_at = datetime.fromisoformat(arg_value)
+        except ValueError:
+            return(None)
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return(max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+
+class RateLimiter:
+    """Token bucket whose refill rate adapts to how Confluence responds.
+
+    The rate is cut on 429/503 and when X-RateLimit-NearLimit is set, and grows
+    back slowly while responses are healthy (additive increase, multiplicative
+    decrease). Retry-After and an exhausted X-RateLimit-Remaining pause every
+    caller until the server says it is fine to continue. Thread-safe; one
+    instance is shared by all clients in the process.
+    """
+
+    def __init__(self,arg_rate=RATE_INITIAL,arg_burst=RATE_BURST,arg_min_rate=RATE_MIN,arg_max_rate=RATE_MAX):
+        self.rate = arg_rate
+        self.capacity = arg_burst
+        self.min_rate = arg_min_rate
+        self.max_rate = arg_max_rate
+        self.tokens = float(arg_burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self,arg_response):
+        """Adapt the rate to a response's status code and rate limit headers."""
+        headers = arg_response.headers
+        retry_after = parse_retry_after(headers.get("Retry-After"))
+        with self.lock:
+            now = time.monotonic()
+            if arg_response.status_code in THROTTLE_STATUSES:
+                self.rate = max(self.min_rate, self.rate * RATE_DECREASE)
+                self.tokens = 0.0
+                self.updated = now
+                pause = retry_after if retry_after is not None else 1 / self.rate
+                self.blocked_until = max(self.blocked_until, now + pause)
+                return
+            if headers.get("X-RateLimit-Remaining") == "0":
+                pause = retry_after
+                if pause is None:
+                    pause = parse_retry_after(headers.get("X-RateLimit-Reset"))
+                if pause:
+                    self.blocked_until = max(self.blocked_until, now + pause)
+            if str(headers.get("X-RateLimit-NearLimit", "")).lower() == "true" or headers.get("X-RateLimit-Remaining") == "0":
+                self.rate = max(self.min_rate, self.rate * RATE_NEAR_LIMIT_DECREASE)
+            else:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE / self.rate)
+
+rate_limiter = RateLimiter()
+
+class ResponseCache:
+    """On-disk cache of Confluence API responses, revalidated with conditional requests.
+
+    Entries are keyed by URL and auth scope (a hash of the credentials, so two
+    accounts never share an entry) and store the body, ETag/Last-Modified and the
+    page version.number when the body has one. ConfluenceClient.get sends
+    If-None-Match/If-Modified-Since for cached URLs and serves a 304 from disk; a
+    caller that already knows the current page version (e.g. from a listing) can
+    skip the request entirely. Least recently used entries are evicted once the
+    bodies add up to more than arg_max_bytes.
+
+    Args:
+        arg_path: Folder for the cache files
+        arg_max_bytes: Size of all cached bodies before eviction starts
     """
+
+    def __init__(self,arg_path,arg_max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        self.path = arg_path
+        self.max_bytes = arg_max_bytes
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "misses": 0, "stored": 0, "evicted": 0}
+        os.makedirs(self.path, exist_ok=True)
+        self.total_bytes = sum(e.stat().st_size for e in os.scandir(self.path) if e.name.endswith(".body"))
+
+    def _key(self,arg_scope,arg_url):
+        return(hashlib.sha256(f"{arg_scope}\n{arg_url}".encode("utf-8")).hexdigest())
+
+    def lookup(self,arg_scope,arg_url):
+        """Return (key, metadata) for a cached URL, metadata is None on a miss."""
+        key = self._key(arg_scope, arg_url)
+        meta = load_json_file(os.path.join(self.path, f"{key}.json"), None)
+        if meta is not None and not os.path.exists(os.path.join(self.path, f"{key}.body")):
+            meta = None
+        return(key, meta)
+
+    def conditional_headers(self,arg_meta):
+        headers = {}
+        if arg_meta.get('etag'):
+            headers['If-None-Match'] = arg_meta['etag']
+        if arg_meta.get('last_modified'):
+            headers['If-Modified-Since'] = arg_meta['last_modified']
+        return(headers)
+
+    def response(self,arg_key,arg_meta,arg_stat):
+        """Build a 200 requests.Response from a cached entry and count it under arg_stat."""
+        body_path = os.path.join(self.path, f"{arg_key}.body")
+        with open(body_path, "rb") as f:
+            content = f.read()
+        os.utime(body_path)         # mtime is the LRU clock
+        response = requests.Response()
+        response.status_code = 200
+        response._content = content
+        response.headers = requests.structures.CaseInsensitiveDict(arg_meta['headers'])
+        response.encoding = arg_meta.get('encoding')
+        response.url = arg_meta['url']
+        response.from_cache = True
+        with self.lock:
+            self.stats[arg_stat] += 1
+        return(response)
+
+    def store(self,arg_key,arg_response):
+        """Cache a 200 response if it can be revalidated (ETag, Last-Modified or page version)."""
+        with self.lock:
+            self.stats['misses'] += 1
+        content = arg_response.content
+        if arg_response.status_code != 200 or len(content) > RESPONSE_CACHE_MAX_ENTRY_BYTES:
+            return
+        version = None
+        if "json" in arg_response.headers.get("Content-Type", ""):
+            try:
+                version = (arg_response.json().get('version') or {}).get('number')
+            except (ValueError, AttributeError):
+                version = None
+        etag = arg_response.headers.get("ETag")
+        last_modified = arg_response.headers.get("Last-Modified")
+        if not (etag or last_modified or version):
+            return
+        meta = {
+            "url": arg_response.url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "version": version,
+            "encoding": arg_response.encoding,
+            "headers": {k: v for k, v in arg_response.headers.items() if k.lower() in ("content-type", "etag", "last-modified")},
+        }
+        body_path = os.path.join(self.path, f"{arg_key}.body")
+        old_size = os.path.getsize(body_path) if os.path.exists(body_path) else 0
+        tmp_path = f"{body_path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, body_path)
+        save_json_file(os.path.join(self.path, f"{arg_key}.json"), meta)
+        with self.lock:
+            self.stats['stored'] += 1
+            self.total_bytes += len(content) - old_size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until the cache is back under 90% of its budget."""
+        with self.lock:
+            bodies = sorted((e for e in os.scandir(self.path) if e.name.endswith(".body")), key=lambda e: e.stat().st_mtime)
+            for entry in bodies:
+                if self.total_bytes <= self.max_bytes * 0.9:
+                    break
+                size = entry.stat().st_size
+                key = entry.name[:-len(".body")]
+                for suffix in (".body", ".json"):
+                    try:
+                        os.remove(os.path.join(self.path, f"{key}{suffix}"))
+                    except FileNotFoundError:
+                        pass
+                self.total_bytes -= size
+                self.stats['evicted'] += 1
+
+    def summary(self):
+        stats = dict(self.stats)
+        return(f"Response cache: {stats['hits']} hits, {stats['revalidated']} revalidated (304), {stats['misses']} misses, {stats['evicted']} evicted, {self.total_bytes / 1024 / 1024:.1f} MB on disk")
+
+response_cache = None       # set by enable_response_cache(), used by every client
+
+def enable_response_cache(arg_path=None,arg_max_bytes=RESPONSE_CACHE_MAX_BYTES):
+    """Turn on the shared on-disk response cache (defaults to .cache/http) and return it."""
+    global response_cache
+    response_cache = ResponseCache(arg_path or os.path.join(cache_dir, "http"), arg_max_bytes)
+    return(response_cache)
+
+class ConfluenceClient:
+    """Keep-alive HTTP session for one Confluence Cloud site.
+
+    All helpers in this module go through a client so that connections are
+    reused across calls and share one retry/backoff policy and default timeout.
+    Every request also takes a token from the process-wide rate_limiter, and
+    throttled (429/503) responses are retried once the limiter allows it.
+    When the shared response_cache is enabled, GETs are revalidated against it.
+
+    Args:
+        arg_site: The site name
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_pool_size: Number of pooled connections to keep open
+        arg_timeout: Default timeout (seconds) for every request
+        arg_retries: Number of retries on connection errors and 500/502/504 responses
+        arg_rate_limiter: RateLimiter to use, defaults to the shared rate_limiter
+    """
+
+    def __init__(self,arg_site,arg_username,arg_api_token,arg_pool_size=DEFAULT_POOL_SIZE,arg_timeout=DEFAULT_TIMEOUT,arg_retries=DEFAULT_RETRIES,arg_rate_limiter=None):
+        self.site = arg_site
+        self.base_url = f"https://{arg_site}.atlassian.net/wiki"
+        self.timeout = arg_timeout
+        self.rate_limiter = arg_rate_limiter if arg_rate_limiter is not None else rate_limiter
+        retry_strategy = Retry(
+            total=arg_retries,
+            backoff_factor=DEFAULT_BACKOFF,
+            status_forcelist=[500, 502, 504],      # 429/503 are handled by the rate limiter in get()
+            allowed_methods=["HEAD", "GET", "OPTIONS"],
+            raise_on_status=False,      # hand the last response back to the caller instead of raising
+            respect_retry_after_header=False    # else urllib3 retries 429/503 with Retry-After itself, outside the limiter
+        )
+        adapter = HTTPAdapter(pool_connections=arg_pool_size, pool_maxsize=arg_pool_size, max_retries=retry_strategy)
+        self.session = requests.Session()
+        self.session.auth = (arg_username, arg_api_token)
+        self.auth_scope = hashlib.sha256(f"{arg_username}:{arg_api_token}".encode("utf-8")).hexdigest()[:16]
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self,arg_url,arg_version=None,**kwargs):
+        """GET a Confluence URL through the pooled session.
+
+        Args:
+            arg_url: Full URL, or a path relative to https://<site>.atlassian.net/wiki
+            arg_version: Current version.number of the page behind the URL, if known.
+                A cached response of that version is returned without a request.
+            **kwargs: Passed on to requests.Session.get
+
+        Returns:
+            response (requests.Response)
+
+        Raises:
+            requests.HTTPError: when the call is still throttled after THROTTLE_RETRIES attempts
+        """
+        if arg_url.startswith("/"):
+            arg_url = f"{self.base_url}{arg_url}"
+        kwargs.setdefault("timeout", self.timeout)
+        cache = response_cache if not kwargs.get("stream") else None
+        if cache is not None:
+            cache_key, cache_meta = cache.lookup(self.auth_scope, arg_url)
+            if cache_meta is not None:
+                if arg_version is not None and cache_meta.get('version') == arg_version:
+                    return(cache.response(cache_key, cache_meta, "hits"))
+                kwargs['headers'] = {**cache.conditional_headers(cache_meta), **(kwargs.get('headers') or {})}
+        for attempt in range(THROTTLE_RETRIES + 1):
+            self.rate_limiter.acquire()
+            response = self.session.get(arg_url, **kwargs)
+            self.rate_limiter.update(response)
+            if response.status_code not in THROTTLE_STATUSES:
+                if cache is not None:
+                    if response.status_code == 304 and cache_meta is not None:
+                        return(cache.response(cache_key, cache_meta, "revalidated"))
+                    cache.store(cache_key, response)
+                return(response)
+            print(f"  [!] Throttled ({response.status_code}) on {arg_url}, now at {self.rate_limiter.rate:.1f} req/s (attempt {attempt + 1})")
+            if attempt < THROTTLE_RETRIES:
+                response.close()
+        response.raise_for_status()     # don't let callers parse a 429 body as if it were the page
+
+    def close(self):
+        self.session.close()
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(arg_site,arg_username,arg_api_token):
+    """Return the shared ConfluenceClient for a site and credentials, creating it on first use."""
+    key = (arg_site, arg_username, arg_api_token)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = ConfluenceClient(arg_site,arg_username,arg_api_token)
+            _clients[key] = client
+    return(client)
+
+#
+# HTML -> text extraction backends
+#
+# Every backend returns the page's text nodes joined by single spaces, the way
+# bs4's get_text(separator=" ", strip=True) does: text of <script>, <style>,
+# <template> and comments is left out, every node is stripped and empty ones
+# are dropped. lxml and selectolax can be chosen when they are installed.
+# On well-formed HTML the three agree. On malformed markup they don't:
+# lxml and selectolax drop stray end tags without a word break
+# ("bar baz</span>x" -> "bar bazx"), and selectolax moves stray text out of
+# tables and glues <noscript> to what follows. So bs4 stays the default and
+# the fast backends are opt-in (benchTextExtraction.py counts the differences).
+#
+TEXT_SKIP_TAGS = ("script", "style", "template")
+# splitlines() boundaries plus runs of two spaces, the places save_plain_text breaks lines
+_text_breaks = re.compile("  |\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]")
+
+def _text_bs4(html_content):
+    return(bs(html_content, "html.parser").get_text(separator=" ", strip=True))
+
+def _text_lxml(html_content):
+    if not html_content.strip():
+        return("")
     try:
-        soup = bs(html_content, "html.parser")
-        plain_text = soup.get_text(separator=" ", strip=True)
+        # huge_tree: without it libxml2 drops text nodes over 10 MB (e.g. a large <pre>)
+        root = lxml_etree.fromstring(html_content, lxml_etree.HTMLParser(huge_tree=True))
+    except ValueError:
+        return(_text_bs4(html_content))     # str input with an <?xml encoding=...?> declaration
+    if root is None:
+        return(_text_bs4(html_content))
+    parts = []
+    skipping = 0        # depth inside script/style/template, whose text is left out but not their tail
+    # comments and processing instructions only come as their own events, their text is dropped, their tail kept
+    for event, el in lxml_etree.iterwalk(root, events=("start", "end", "comment", "pi")):
+        if event in ("comment", "pi"):
+            if not skipping and el.tail:
+                parts.append(el.tail)
+            continue
+        skipped = el.tag in TEXT_SKIP_TAGS
+        if event == "start":
+            if skipped:
+                skipping += 1
+            elif not skipping and el.text:
+                parts.append(el.text)
+        else:
+            if skipped:
+                skipping -= 1
+            if not skipping and el.tail:
+                parts.append(el.tail)
+    text = " ".join(t for t in (t.strip() for t in parts) if t)
+    # never write an empty page where bs4 finds text, whatever libxml2 dropped
+    return(text or _text_bs4(html_content))
+
+def _text_selectolax(html_content):
+    tree = LexborHTMLParser(html_content)
+    tree.strip_tags(list(TEXT_SKIP_TAGS))
+    if tree.root is None:
+        return("")
+    return(" ".join(t for t in (n.text_content.strip() for n in tree.root.traverse(include_text=True) if n.tag == "-text") if t))
+
+text_backends = {"bs4": _text_bs4}
+try:
+    from lxml import etree as lxml_etree
+    text_backends["lxml"] = _text_lxml
+except ImportError:
+    pass
+try:
+    from selectolax.lexbor import LexborHTMLParser
+    text_backends["selectolax"] = _text_selectolax
+except ImportError:
+    pass
+text_backend = "bs4"
+
+def set_text_backend(arg_name):
+    """Choose the extraction backend used by save_plain_text ("lxml", "selectolax" or "bs4")."""
+    global text_backend
+    if arg_name not in text_backends:
+        raise ValueError(f"Text backend '{arg_name}' is not available, installed: {', '.join(text_backends)}")
+    text_backend = arg_name
+
+def html_to_text(html_content, arg_backend=None):
+    """Extract the text of an HTML string, one line per text block
+
+    Lines break where the text has line breaks or runs of two spaces, each
+    line is stripped and empty lines are dropped, in a single split.
+
+    Args:
+        html_content: HTML string
+        arg_backend: Backend name, defaults to text_backend
+    """
+    plain_text = text_backends[arg_backend or text_backend](html_content)
+    return("\n".join(chunk for chunk in (phrase.strip() for phrase in _text_breaks.split(plain_text)) if chunk))
+
+# h1-h3 of export_view HTML, the boundaries of the sections written by page_sections
+_section_headings = re.compile(r"<h([1-3])(?:\s[^>]*)?>(.*?)</h\1\s*>", re.IGNORECASE | re.DOTALL)
+
+def page_sections(html_content):
+    """Split a page's HTML into heading-scoped sections (h1-h3)
+
+    Same shape as gdocs_importer.doc_sections: text before the first heading
+    is an "INTRO" section of level 1, sections without text are dropped and
+    the remaining ones are numbered in page order. The HTML is scanned once
+    for the headings and every slice between them is converted with
+    html_to_text, so deeper headings (h4-h6) stay inside their section.
+
+    Args:
+        html_content: HTML string (export_view)
+
+    Returns:
+        sections (list): dicts with 'section_index', 'section_heading', 'section_level' and 'text'
+    """
+    sections = []
+    heading, level, start = "INTRO", 1, 0
+
+    def _flush(end):
+        text = html_to_text(html_content[start:end]).replace("\n", " ")
+        if text:
+            sections.append({
+                "section_index": len(sections),
+                "section_heading": heading,
+                "section_level": level,
+                "text": text,
+            })
+
+    for match in _section_headings.finditer(html_content):
+        _flush(match.start())
+        level = int(match.group(1))
+        heading = html_to_text(match.group(2)).replace("\n", " ") or f"HEADING_{level}"
+        start = match.end()
+    _flush(len(html_content))
+    return(sections)
+
+def section_records(arg_sections,arg_page_id,arg_title,arg_url,arg_version=None,arg_updated=None):
+    """Turn page_sections output into JSONL records, with the gdocs_importer fields
+
+    _id is "Confluence:<page id>#<section index>", stable for as long as the
+    page's sections don't change.
+    """
+    page_id = str(arg_page_id)
+    return([{
+        "_id": f"Confluence:{page_id}#{s['section_index']:03d}",
+        "text": s["text"],
+        "source": "confluence",
+        "doc_id": page_id,
+        "title": arg_title,
+        "section_heading": s["section_heading"],
+        "section_level": s["section_level"],
+        "url": arg_url,
+        "version": arg_version,
+        "updated_at": arg_updated,
+        "doc_ids": [page_id],
+    } for s in arg_sections])
+
+json_output_dir = None      # set by set_json_output(), where save_plain_text also writes preprocess_docs records
+json_output_sharded = False
 
-        lines = (line.strip() for line in plain_text.splitlines())
-        chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-        cleaned_text = "\n".join(chunk for chunk in chunks if chunk)
+def set_json_output(arg_dir,arg_sharded=False):
+    """Also write the preprocess_docs JSON record of every exported page into arg_dir (None to stop).
 
-        with open(output_filepath, "w", encoding="utf-8") as f:
-            f.write(cleaned_text)
+    With arg_sharded the records go into a preprocess_docs.ShardStore in
+    arg_dir, keyed by page ID, instead of one .json file per page.
+    """
+    global json_output_dir, json_output_sharded
+    json_output_dir = arg_dir
+    json_output_sharded = arg_sharded
+
+_record_stores = {}
+_record_stores_lock = threading.Lock()
+
+def get_record_store(arg_dir):
+    """Return this process's ShardStore writer for arg_dir."""
+    with _record_stores_lock:
+        store = _record_stores.get(arg_dir)
+        if store is None:
+            store = preprocess_docs.ShardStore(arg_dir)
+            _record_stores[arg_dir] = store
+    return(store)
+
+def save_plain_text(html_content, output_filepath, arg_record_key=None):
+    """
+    Extracts plain text from an HTML string (see html_to_text)
+    and saves it to a file. Returns True when the file was written.
+
+    When set_json_output() is on, the text is also cleaned the way
+    preprocess_docs.process_all_files does and its JSON record is written right
+    away, without reading the .txt back or parsing it a second time. In sharded
+    mode it is stored under arg_record_key (the page ID), or its name.
+    """
+    try:
+        cleaned_text = html_to_text(html_content)
+
+        write_text_atomic(output_filepath, cleaned_text)
         print(f"  |-> Saved plain text to {output_filepath}")
+        if json_output_dir is not None:
+            # the text came out of an HTML parser already, so only the URL/whitespace part of clean_text is needed
+            record = preprocess_docs.build_record(preprocess_docs.normalize_text(cleaned_text), os.path.abspath(output_filepath))
+            if json_output_sharded:
+                get_record_store(json_output_dir).put(str(arg_record_key or record['name']), record)
+                print(f"  |-> Saved record to {json_output_dir} shards")
+            else:
+                print(f"  |-> Saved record to {preprocess_docs.save_record(record, json_output_dir)}")
+        return True
     except Exception as e:
         print(f"  [!] Could not save plain text file: {e}")
+        return False
 
 
 def sanitize_filename(title: str) -> str:
@@ -117,73 +657,477 @@ def get_space_title(arg_site,arg_space_id,arg_username,arg_api_token):
     """
     server_url = (f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/{arg_space_id}")
 
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30).json()['name']
+    response = get_client(arg_site,arg_username,arg_api_token).get(server_url).json()['name']
     return(response)
 
-def get_spaces_all(arg_site,arg_username,arg_api_token):
+def iter_results(arg_client,arg_server_url):
+    """Yield the records of a cursor-paginated v2 listing as each response arrives.
+
+    Each response is parsed once and its records are handed out before the
+    next cursor page is requested, so memory stays at one response.
+
+    Args:
+        arg_client: ConfluenceClient to use
+        arg_server_url: URL of the first page of the listing (must already have a query string)
+
+    Raises:
+        requests.HTTPError: when a listing call doesn't return a 2xx response
+    """
+    response = arg_client.get(arg_server_url)
+    while True:
+        response.raise_for_status()  # raises exception when not a 2xx response
+        data = response.json()
+        yield from data['results']
+        next_link = data.get('_links', {}).get('next')
+        if not next_link:
+            return
+        cursor = parse_qs(urlparse(next_link).query)['cursor'][0]
+        response = arg_client.get(f"{arg_server_url}&cursor={quote(cursor, safe='')}")
+
+def iter_spaces_all(arg_site,arg_username,arg_api_token):
+    """Yield every space of the site, one listing page at a time."""
+    client = get_client(arg_site,arg_username,arg_api_token)
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/?limit=250"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30)
-    response.raise_for_status()  # raises exception when not a 2xx response
-    space_list = response.json()['results']
-    while 'next' in response.json()['_links'].keys():
-        cursorserver_url = f"{server_url}&cursor{response.json()['_links']['next'].split('cursor')[1]}"
-        response = requests.get(cursorserver_url, auth=(arg_username,arg_api_token),timeout=30)
-        space_list = space_list + response.json()['results']
-    return(space_list)
-
-def get_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token):
-    page_list = []
+    yield from iter_results(client,server_url)
+
+def get_spaces_all(arg_site,arg_username,arg_api_token):
+    return(list(iter_spaces_all(arg_site,arg_username,arg_api_token)))
+
+_space_cache_lock = threading.Lock()
+
+def load_json_file(arg_path,arg_default):
+    try:
+        with open(arg_path, "r", encoding="utf-8") as f:
+            return(json.load(f))
+    except (OSError, ValueError):
+        return(arg_default)
+
+def write_text_atomic(arg_path,arg_text):
+    """Write a text file through a temp file that is synced and renamed in place, so a crash never leaves it truncated."""
+    tmp_path = f"{arg_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(arg_text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, arg_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_json_file(arg_path,arg_data):
+    """Write JSON next to its final path and rename it in place so readers never see half a file."""
+    os.makedirs(os.path.dirname(arg_path), exist_ok=True)
+    tmp_path = f"{arg_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(arg_data, f, indent=2)
+    os.replace(tmp_path, arg_path)
+
+def resolve_space(arg_site,arg_space_key,arg_username,arg_api_token,arg_cache_path=None,arg_ttl=SPACE_CACHE_TTL):
+    """Find a space by its key without listing every space of the site
+
+    Looks in the on-disk cache first, then asks the v2 spaces endpoint for the key
+    directly (keys=). Only if that finds nothing are the spaces listed, stopping at the match.
+
+    Args:
+        arg_site: The site name
+        arg_space_key: Space key, matched case-insensitively
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_cache_path: JSON file with cached mappings, defaults to .cache/spaces.json
+        arg_ttl: Seconds a cached mapping is trusted, 0 to bypass the cache
+
+    Returns:
+        space (dict): 'id', 'key', 'name' and 'homepageId', or None if the key doesn't exist
+    """
+    cache_path = arg_cache_path or os.path.join(cache_dir, "spaces.json")
+    cache_key = arg_space_key.upper()
+    with _space_cache_lock:
+        cache = load_json_file(cache_path, {})
+    cached = cache.get(arg_site, {}).get(cache_key)
+    if cached and arg_ttl and time.time() - cached['cached_at'] < arg_ttl:
+        return(cached['space'])
+
+    client = get_client(arg_site,arg_username,arg_api_token)
+    space = None
+    for key in dict.fromkeys([cache_key, arg_space_key]):      # keys= is case-sensitive, most keys are upper case
+        response = client.get(f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces?keys={quote(key, safe='')}&limit=1")
+        response.raise_for_status()
+        results = response.json()['results']
+        if results:
+            space = results[0]
+            break
+    if space is None:
+        for n in iter_spaces_all(arg_site,arg_username,arg_api_token):
+            if n['key'].lower() == arg_space_key.lower():
+                space = n
+                break
+    if space is None:
+        return(None)
+
+    space = {'id': space['id'], 'key': space['key'], 'name': space['name'], 'homepageId': space.get('homepageId')}
+    with _space_cache_lock:
+        cache = load_json_file(cache_path, {})
+        cache.setdefault(arg_site, {})[cache_key] = {'cached_at': time.time(), 'space': space}
+        save_json_file(cache_path, cache)
+    return(space)
+
+def iter_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token,arg_body_format=None,arg_space_key=None):
+    """Yield all current pages of a space as the listing is paginated
+
+    Without arg_body_format the pages come from the v2 listing. The v2
+    listings only serve storage and atlas_doc_format bodies, so with
+    arg_body_format (export_view) the space is listed through the v1 CQL
+    search instead, which expands the body, the version and the ancestors of
+    every result. Those records get 'parentId' and 'spaceId' like the v2 ones.
+
+    Args:
+        arg_site: The site name
+        arg_space_id: ID of the space
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_body_format: Include each page body in this format (e.g. INLINE_BODY_FORMAT)
+        arg_space_key: Key of the space, needed with arg_body_format
+
+    Yields:
+        page (dict): v2 page record, or v1 content record with 'body' when arg_body_format is given
+    """
+    if arg_body_format:
+        if not arg_space_key:
+            raise ValueError("arg_space_key is needed to list the pages with their body")
+        cql = f"space = {cql_string(arg_space_key)} AND type = page order by created"
+        for page in iter_cql_search(arg_site,cql,arg_username,arg_api_token,arg_expand=f"version,ancestors,body.{arg_body_format}"):
+            ancestors = page.pop('ancestors', None) or []
+            page['parentId'] = ancestors[-1]['id'] if ancestors else None
+            page['spaceId'] = str(arg_space_id)
+            yield page
+        return
+    client = get_client(arg_site,arg_username,arg_api_token)
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/{arg_space_id}/pages?status=current&limit=250"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30)
-    page_list = response.json()['results']
-    while 'next' in response.json()['_links'].keys():
-        cursorserver_url = f"{server_url}&cursor{response.json()['_links']['next'].split('cursor')[1]}"
-        response = requests.get(cursorserver_url, auth=(arg_username,arg_api_token),timeout=30)
-        page_list = page_list + response.json()['results']
-    return(page_list)
-
-def get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token):
+    yield from iter_results(client,server_url)
+
+def get_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token,arg_body_format=None,arg_space_key=None):
+    """Get all current pages of a space as a list, see iter_pages_from_space."""
+    return(list(iter_pages_from_space(arg_site,arg_space_id,arg_username,arg_api_token,arg_body_format,arg_space_key)))
+
+def iter_blogposts_from_space(arg_site,arg_space_id,arg_username,arg_api_token):
+    """Yield all current blog posts of a space (v2 records, without bodies) as the listing is paginated."""
+    client = get_client(arg_site,arg_username,arg_api_token)
+    server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/spaces/{arg_space_id}/blogposts?status=current&limit=250"
+    yield from iter_results(client,server_url)
+
+def iter_cql_search(arg_site,arg_cql,arg_username,arg_api_token,arg_expand=None,arg_limit=CQL_PAGE_SIZE):
+    """Yield the content matching a CQL query, following the search pagination
+
+    Results are handed out as each page of the search arrives, so callers can
+    start working on the first matches while the rest are still being fetched.
+
+    Args:
+        arg_site: The site name
+        arg_cql: CQL query
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_expand: Expansions to request (e.g. "version"); keep it to what the caller reads
+        arg_limit: Results per call
+
+    Yields:
+        content (dict): v1 content record ('id', 'type', 'title', '_links', plus arg_expand)
+    """
+    client = get_client(arg_site,arg_username,arg_api_token)
+    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/search?cql={quote(arg_cql)}&limit={arg_limit}"
+    if arg_expand:
+        server_url = f"{server_url}&expand={arg_expand}"
+    while server_url:
+        response = client.get(server_url, headers={"Accept": "application/json"})
+        response.raise_for_status()
+        data = response.json()
+        yield from data['results']
+        links = data.get('_links', {})
+        next_link = links.get('next')
+        server_url = f"{links.get('base', client.base_url)}{next_link}" if next_link else None
+
+def cql_string(arg_value):
+    """Quote a value for a CQL query."""
+    return('"' + arg_value.replace('\\', '\\\\').replace('"', '\\"') + '"')
+
+def iter_pages_by_label(arg_site,arg_labels,arg_username,arg_api_token,arg_space_key=None,arg_body_format=None):
+    """Yield the current pages having any of the labels, as the CQL search is paginated
+
+    The records can go straight into export_pages: they carry 'id', 'title',
+    'version' and '_links' like the space listing, and 'body' when
+    arg_body_format is given (expanded in the search, so no call per page).
+
+    Args:
+        arg_site: The site name
+        arg_labels: Label names
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_space_key: Only search this space
+        arg_body_format: Body format to expand in the results (e.g. INLINE_BODY_FORMAT)
+    """
+    cql = f"type = page AND label in ({','.join(cql_string(label) for label in arg_labels)})"
+    if arg_space_key:
+        cql = f"{cql} AND space = {cql_string(arg_space_key)}"
+    expand = f"version,body.{arg_body_format}" if arg_body_format else "version"
+    yield from iter_cql_search(arg_site,f"{cql} order by created",arg_username,arg_api_token,arg_expand=expand)
+
+def get_inline_body(arg_page,arg_body_format=INLINE_BODY_FORMAT):
+    """Return the body HTML included in a listing record, or None when it has to be fetched separately."""
+    body = (arg_page.get('body') or {}).get(arg_body_format) or {}
+    return(body.get('value'))
+
+def get_body_export_view(arg_site,arg_page_id,arg_username,arg_api_token,arg_version=None):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=body.export_view"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token))
+    response = get_client(arg_site,arg_username,arg_api_token).get(server_url,arg_version=arg_version)
     return(response)
 
 def get_page_name(arg_site,arg_page_id,arg_username,arg_api_token):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}"
-    r_pagetree = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
+    r_pagetree = get_client(arg_site,arg_username,arg_api_token).get(server_url)
     return(r_pagetree.json()['id'] + "_" + r_pagetree.json()['title'])
 
+_page_titles = {}          # (site, page id) -> title, kept for the whole run
+_page_titles_lock = threading.Lock()
+
+def get_page_titles(arg_site,arg_page_ids,arg_username,arg_api_token):
+    """Get the titles of many pages with one v2 /pages?id= call per PAGE_ID_BATCH ids
+
+    Titles are memoized for the rest of the run, so ids seen before (e.g. in
+    another Page Properties report) cost nothing. Ids the bulk call doesn't
+    return are looked up one by one with get_page_name.
+
+    Returns:
+        titles (dict): page id (str) -> title
+    """
+    page_ids = [str(i) for i in dict.fromkeys(arg_page_ids)]
+    with _page_titles_lock:
+        missing = [i for i in page_ids if (arg_site, i) not in _page_titles]
+    client = get_client(arg_site,arg_username,arg_api_token)
+    for start in range(0, len(missing), PAGE_ID_BATCH):
+        batch = missing[start:start + PAGE_ID_BATCH]
+        server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/pages?id={','.join(batch)}&limit={PAGE_ID_BATCH}"
+        found = {str(page['id']): page['title'] for page in iter_results(client,server_url)}
+        for page_id in batch:
+            if page_id not in found:
+                found[page_id] = get_page_name(arg_site,page_id,arg_username,arg_api_token).split('_',1)[1]
+        with _page_titles_lock:
+            _page_titles.update({(arg_site, i): title for i, title in found.items()})
+    with _page_titles_lock:
+        return({i: _page_titles[(arg_site, i)] for i in page_ids})
+
 def get_page_parent(arg_site,arg_page_id,arg_username,arg_api_token):
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/pages/{arg_page_id}"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
+    response = get_client(arg_site,arg_username,arg_api_token).get(server_url)
     return(response.json()['parentId'])
 
 def remove_illegal_characters(input):
     return re.sub(r'[^\w_\.\- ]+', '_', input)
 
-def get_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token):
+def download_attachment(arg_client,arg_url,arg_file_path,arg_expected_size=None):
+    """Stream a file to disk, resuming a partial download and replacing the target only when complete
+
+    The body is written in chunks to <file>.part so memory stays flat whatever the
+    file size. A .part left by an earlier attempt (or run) is continued with an
+    HTTP Range request; if the server ignores the range the file starts over.
+    Once the size matches arg_expected_size the .part is renamed into place.
+
+    Args:
+        arg_client: ConfluenceClient to use
+        arg_url: Download URL
+        arg_file_path: Final path of the file
+        arg_expected_size: Size in bytes from the attachment metadata, if known
+
+    Returns:
+        ok (bool): True when the file is complete at arg_file_path
+    """
+    part_path = f"{arg_file_path}.part"
+    for attempt in range(ATTACHMENT_ATTEMPTS):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if arg_expected_size is not None and offset > arg_expected_size:
+            os.remove(part_path)
+            offset = 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            if arg_expected_size is None or offset < arg_expected_size:
+                with arg_client.get(arg_url,allow_redirects=True,stream=True,headers=headers) as response:
+                    if response.status_code == 416:        # nothing left to send, the .part is already complete
+                        pass
+                    else:
+                        response.raise_for_status()
+                        mode = "ab" if offset and response.status_code == 206 else "wb"
+                        with open(part_path, mode) as f:
+                            for chunk in response.iter_content(chunk_size=ATTACHMENT_CHUNK_SIZE):
+                                f.write(chunk)
+            size = os.path.getsize(part_path)
+            if arg_expected_size is not None and size != arg_expected_size:
+                raise IOError(f"got {size} of {arg_expected_size} bytes")
+            os.replace(part_path, arg_file_path)
+            return(True)
+        except (requests.RequestException, IOError) as e:
+            print(f"WARNING: Attempt {attempt + 1} for {os.path.basename(arg_file_path)} failed: {e}")
+    return(False)
+
+def file_sha256(arg_path):
+    sha = hashlib.sha256()
+    with open(arg_path, "rb") as f:
+        for chunk in iter(lambda: f.read(ATTACHMENT_CHUNK_SIZE), b""):
+            sha.update(chunk)
+    return(sha.hexdigest())
+
+class BlobStore:
+    """Content-addressed file store (sha256 -> file) shared by every page of an export.
+
+    index.json maps a download key ("attachment:<id>:<version>" or "url:<url>")
+    to the hash of its content, so a file that is already stored is not
+    downloaded again, and maps the local file names handed out to pages to the
+    hash they point at, so two different files with the same sanitized title
+    don't overwrite or shadow each other. Page files are hard links to the blob
+    (a copy where links aren't supported), so identical content is stored once.
+
+    Args:
+        arg_path: Folder of the store
+    """
+
+    def __init__(self,arg_path):
+        self.path = arg_path
+        self.index_path = os.path.join(arg_path, "index.json")
+        self.index = load_json_file(self.index_path, {})
+        self.index.setdefault("keys", {})
+        self.index.setdefault("names", {})
+        self.lock = threading.Lock()
+        self.stats = {"reused": 0, "downloaded": 0, "deduplicated": 0, "failed": 0}
+        os.makedirs(os.path.join(arg_path, "tmp"), exist_ok=True)
+
+    def blob_path(self,arg_sha):
+        return(os.path.join(self.path, arg_sha[:2], arg_sha))
+
+    def lookup(self,arg_key):
+        """Return the hash stored for a download key, or None if it has to be downloaded."""
+        with self.lock:
+            sha = self.index["keys"].get(arg_key)
+        if sha and os.path.exists(self.blob_path(sha)):
+            return(sha)
+        return(None)
+
+    def add_file(self,arg_key,arg_file_path):
+        """Move a downloaded file into the store under its hash and return the hash."""
+        sha = file_sha256(arg_file_path)
+        blob_path = self.blob_path(sha)
+        if os.path.exists(blob_path):
+            os.remove(arg_file_path)
+            stat = "deduplicated"
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(arg_file_path, blob_path)
+            stat = "downloaded"
+        with self.lock:
+            self.index["keys"][arg_key] = sha
+            self.stats[stat] += 1
+        return(sha)
+
+    def fetch(self,arg_client,arg_key,arg_url,arg_expected_size=None):
+        """Return the hash for a download key, downloading the URL only when the key is unknown."""
+        sha = self.lookup(arg_key)
+        if sha is not None:
+            with self.lock:
+                self.stats["reused"] += 1
+            return(sha)
+        tmp_path = os.path.join(self.path, "tmp", hashlib.sha256(arg_key.encode("utf-8")).hexdigest())     # stable, so a partial download resumes next run
+        if not download_attachment(arg_client,arg_url,tmp_path,arg_expected_size):
+            with self.lock:
+                self.stats["failed"] += 1
+            return(None)
+        return(self.add_file(arg_key,tmp_path))
+
+    def link(self,arg_sha,arg_dir,arg_name):
+        """Make arg_dir/arg_name point at a blob and return the name used.
+
+        If the name is already taken by different content, the file gets a
+        -<hash> suffix instead of replacing it.
+        """
+        with self.lock:     # held throughout so two pages can't claim the same name at once
+            name = arg_name
+            file_path = os.path.join(arg_dir, name)
+            taken_by = self.index["names"].get(name)
+            if os.path.exists(file_path) and taken_by is None:
+                taken_by = file_sha256(file_path)       # file from before the store existed
+            if taken_by is not None and taken_by != arg_sha:
+                stem, ext = os.path.splitext(arg_name)
+                name = f"{stem}-{arg_sha[:8]}{ext}"
+                file_path = os.path.join(arg_dir, name)
+            if not os.path.exists(file_path):
+                try:
+                    os.link(self.blob_path(arg_sha), file_path)
+                except OSError:
+                    shutil.copyfile(self.blob_path(arg_sha), file_path)
+            self.index["names"][name] = arg_sha
+        return(name)
+
+    def save(self):
+        with self.lock:
+            save_json_file(self.index_path, self.index)
+
+_blob_stores = {}
+_blob_stores_lock = threading.Lock()
+
+def get_blob_store(arg_outdir_attach):
+    """Return the BlobStore kept in <attachments folder>/.blobs, shared by all pages using that folder."""
+    path = os.path.join(arg_outdir_attach, ".blobs")
+    with _blob_stores_lock:
+        store = _blob_stores.get(path)
+        if store is None:
+            store = BlobStore(path)
+            _blob_stores[path] = store
+    return(store)
+
+def get_attachments(arg_site,arg_page_id,arg_outdir_attach,arg_username,arg_api_token,arg_attachments=None):
+    """Download the attachments of a page into the shared attachments folder
+
+    Attachments go through the folder's BlobStore: an attachment id+version that
+    was already downloaded (for this or any other page) is not fetched again,
+    and the page gets a link to the stored file.
+
+    Args:
+        arg_attachments: Attachment records already fetched (e.g. PageBundle.attachments), skips the listing call
+
+    Returns:
+        my_attachments_list (list): Local file names of the attachments
+    """
     my_attachments_list = []
-    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=children.attachment"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token),timeout=30)
-    my_attachments = response.json()['children']['attachment']['results']
-    for attachment in my_attachments:
+    client = get_client(arg_site,arg_username,arg_api_token)
+    store = get_blob_store(arg_outdir_attach)
+    if arg_attachments is not None:
+        my_attachments = arg_attachments
+    else:
+        server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=children.attachment"
+        response = client.get(server_url)
+        my_attachments = list(iter_expanded(client, response.json()['children']['attachment']))
+
+    def _fetch(attachment):
         attachment_title = remove_illegal_characters(requests.utils.unquote(attachment['title']).replace(" ","_").replace(":","-"))         # I want attachments without spaces
-        attachment_file_path = os.path.join(arg_outdir_attach,attachment_title)
-        if not os.path.exists(attachment_file_path):
+        attachment_url = f"https://{arg_site}.atlassian.net/wiki{attachment['_links']['download']}"
+        attachment_size = (attachment.get('extensions') or {}).get('fileSize')
+        attachment_version = (attachment.get('version') or {}).get('number', attachment_size)
+        attachment_key = f"attachment:{attachment['id']}:{attachment_version}"
+        if store.lookup(attachment_key) is None:
             print(f"Downloading: {attachment_title}")
-            try:
-                attachment_url = f"https://{arg_site}.atlassian.net/wiki{attachment['_links']['download']}"
-                request_attachment = requests.get(attachment_url, auth=(arg_username, arg_api_token),allow_redirects=True,timeout=30)
-                open(attachment_file_path, 'wb').write(request_attachment.content)
-            except:
-                print(f"WARNING: Skipping attachment file {attachment_file_path} due to issues. url: {attachment_url}")
-        my_attachments_list.append(attachment_title)
+        sha = store.fetch(client,attachment_key,attachment_url,attachment_size)
+        if sha is None:
+            print(f"WARNING: Skipping attachment file {os.path.join(arg_outdir_attach,attachment_title)} due to issues. url: {attachment_url}")
+            return(attachment_title)
+        return(store.link(sha,arg_outdir_attach,attachment_title))
+
+    with ThreadPoolExecutor(max_workers=ATTACHMENT_CONCURRENCY) as executor:
+        my_attachments_list = list(executor.map(_fetch, my_attachments))
+    store.save()
     return(my_attachments_list)
 
 # get page labels
 def get_page_labels(arg_site,arg_page_id,arg_username,arg_api_token):
     html_labels = []
     server_url = f"https://{arg_site}.atlassian.net/wiki/api/v2/pages/{arg_page_id}/labels"
-    response = requests.get(server_url, auth=(arg_username,arg_api_token),timeout=30).json()
+    response = get_client(arg_site,arg_username,arg_api_token).get(server_url).json()
     for l in response['results']:
         html_labels.append(l['name'])
         print(f"Label: {l['name']}")
@@ -197,11 +1141,12 @@ def get_page_properties_children(arg_site,arg_html,arg_outdir,arg_username,arg_a
     soup = bs(arg_html, "html.parser")
     my_page_properties_items = soup.findAll('td',class_="title")
     my_page_properties_items_counter = 0
+    my_page_titles = get_page_titles(arg_site,[str(n['data-content-id']) for n in my_page_properties_items],arg_username,arg_api_token)     # all rows in bulk
     for n in my_page_properties_items:
         my_page_id = str(n['data-content-id'])
         my_page_properties_children.append(str(n['data-content-id']))
         my_page_properties_items_counter = my_page_properties_items_counter + 1
-        my_page_name = get_page_name(arg_site,int(my_page_id),arg_username,arg_api_token).rsplit('_',1)[1].replace(":","-").replace(" ","_").replace("%20","_")          # replace offending characters from file name
+        my_page_name = f"{my_page_id}_{my_page_titles[my_page_id]}".rsplit('_',1)[1].replace(":","-").replace(" ","_").replace("%20","_")          # replace offending characters from file name
         my_page_properties_children_dict.update({ my_page_id:{}})
         my_page_properties_children_dict[my_page_id].update({"ID": my_page_id})
         my_page_properties_children_dict[my_page_id].update({"Name": my_page_name})
@@ -210,9 +1155,117 @@ def get_page_properties_children(arg_site,arg_html,arg_outdir,arg_username,arg_a
 
 def get_editor_version(arg_site,arg_page_id,arg_username,arg_api_token):
     server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand=metadata.properties.editor"
-    response = requests.get(server_url, auth=(arg_username, arg_api_token))
+    response = get_client(arg_site,arg_username,arg_api_token).get(server_url)
     return(response)
 
+def editor_version_from(arg_content):
+    """Return "v2" when a v1 content record (expanded with metadata.properties.editor) has the editor property, else "v1"."""
+    try:
+        arg_content['metadata']['properties']['editor']['value']
+    except (KeyError, TypeError):
+        return("v1")
+    return("v2")
+
+PAGE_BUNDLE_EXPAND = "body.export_view,version,space,ancestors,metadata.labels,metadata.properties.editor,children.attachment"
+PAGE_BODY_EXPAND = "body.export_view,version"      # what export_page_by_id needs
+
+@dataclass
+class PageBundle:
+    """Everything the exporter needs about one page, see fetch_page_bundle.
+
+    labels and attachments only hold the first page of their collection until
+    they are read; reading them fetches the rest (_links.next), once.
+    """
+    page_id: str
+    title: str
+    url: str
+    version: int
+    space_key: str
+    html: str
+    ancestors: list             # [{'id', 'title'}] from the space root down to the parent
+    editor_version: str         # None when metadata.properties.editor wasn't expanded
+    label_collection: dict = None
+    attachment_collection: dict = None
+    client: object = field(default=None, repr=False, compare=False)
+    _collected: dict = field(default_factory=dict, repr=False, compare=False)
+
+    def _collect(self,arg_name,arg_collection):
+        if arg_name not in self._collected:
+            self._collected[arg_name] = list(iter_expanded(self.client, arg_collection))
+        return(self._collected[arg_name])
+
+    @property
+    def labels(self):
+        return([l['name'] for l in self._collect('labels', self.label_collection)])
+
+    @property
+    def attachments(self):
+        """Raw attachment records, as expected by get_attachments arg_attachments."""
+        return(self._collect('attachments', self.attachment_collection))
+
+    @property
+    def parent_id(self):
+        return(self.ancestors[-1]['id'] if self.ancestors else None)
+
+    @property
+    def labels_text(self):
+        """Labels joined the way get_page_labels returns them."""
+        return(", ".join(self.labels))
+
+def iter_expanded(arg_client,arg_collection):
+    """Yield the results of an expanded v1 collection (e.g. children.attachment), following its _links.next.
+
+    Expanded collections only hold their first page (25 attachments by
+    default), the rest is fetched here.
+    """
+    while arg_collection:
+        yield from arg_collection.get('results', [])
+        next_link = (arg_collection.get('_links') or {}).get('next')
+        if not next_link:
+            return
+        response = arg_client.get(f"{arg_client.base_url}{next_link}")
+        response.raise_for_status()
+        arg_collection = response.json()
+
+def fetch_page_bundle(arg_site,arg_page_id,arg_username,arg_api_token,arg_version=None,arg_expand=PAGE_BUNDLE_EXPAND):
+    """Get body, labels, ancestors, version, attachment listing and editor property of a page in one request
+
+    Stands in for separate calls to get_body_export_view, get_page_labels, get_page_parent,
+    get_attachments (listing), get_page_name and get_editor_version. Labels and
+    attachments past the first page of their collection are only fetched when
+    the bundle's labels/attachments are read.
+
+    Args:
+        arg_site: The site name
+        arg_page_id: Page ID
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_version: Current version.number of the page if known, lets the response cache skip the request
+        arg_expand: Expansions to request, PAGE_BODY_EXPAND when only the body is needed
+
+    Returns:
+        bundle (PageBundle)
+    """
+    client = get_client(arg_site,arg_username,arg_api_token)
+    server_url = f"https://{arg_site}.atlassian.net/wiki/rest/api/content/{arg_page_id}?expand={arg_expand}"
+    response = client.get(server_url,arg_version=arg_version)
+    response.raise_for_status()
+    content = response.json()
+    metadata = content.get('metadata') or {}
+    return(PageBundle(
+        page_id=str(content['id']),
+        title=content['title'],
+        url=f"{content['_links']['base']}{content['_links']['webui']}",
+        version=(content.get('version') or {}).get('number'),
+        space_key=(content.get('space') or {}).get('key'),
+        html=content['body']['export_view']['value'],
+        ancestors=[{'id': str(a['id']), 'title': a['title']} for a in content.get('ancestors', [])],
+        editor_version=editor_version_from(content) if "metadata.properties.editor" in arg_expand else None,
+        label_collection=metadata.get('labels'),
+        attachment_collection=(content.get('children') or {}).get('attachment'),
+        client=client,
+    ))
+
 # def dump_html(
 #     arg_site,
 #     arg_html,
@@ -507,6 +1560,7 @@ def dump_html(
     This function now ONLY saves a plain text file.
     It keeps the original arguments to maintain the script's structure.
     All arguments except arg_html, arg_title, and arg_outdir_content are ignored.
+    Returns True when the text file was written.
     """
     
     try:
@@ -520,9 +1574,474 @@ def dump_html(
         
         # 3. Call the save_plain_text function
         # (This assumes 'save_plain_text' is defined elsewhere in your script)
-        save_plain_text(arg_html, text_filepath)
+        return save_plain_text(arg_html, text_filepath, arg_page_id)
 
     except NameError as e:
         print(f"  [!] ERROR: A helper function (like 'save_plain_text' or 'sanitize_filename') is missing: {e}")
     except Exception as e:
-        print(f"  [!] ERROR saving {arg_title}: {e}")
\ No newline at end of file
+        print(f"  [!] ERROR saving {arg_title}: {e}")
+    return False
+
+class PageTree:
+    """Page hierarchy of a space, built from the parentId of the listing records.
+
+    Pages are numbered in listing order; parents, depths and the children
+    adjacency (CSR: children[child_offsets[i]:child_offsets[i + 1]]) are kept
+    in flat arrays of those numbers, so the whole tree is built in one linear
+    pass without asking Confluence for any parent. Pages whose parent isn't in
+    the listing are treated as roots.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.titles = []
+        self.positions = []
+        self.parent_ids = []
+        self.built = False
+
+    def add(self,arg_page):
+        self.ids.append(str(arg_page['id']))
+        self.titles.append(arg_page['title'])
+        self.positions.append(arg_page.get('position') or 0)
+        self.parent_ids.append(str(arg_page['parentId']) if arg_page.get('parentId') else None)
+        self.built = False
+
+    def collect(self,arg_pages):
+        """Record every page of a listing while passing it on, e.g. to export_pages."""
+        for page in arg_pages:
+            self.add(page)
+            yield page
+
+    def build(self):
+        n = len(self.ids)
+        index = {page_id: i for i, page_id in enumerate(self.ids)}
+        self.parent = array('l', (index.get(p, -1) if p else -1 for p in self.parent_ids))
+        # children adjacency, counting sort by parent keeps listing order within a parent
+        self.child_offsets = array('l', [0] * (n + 1))
+        for p in self.parent:
+            if p >= 0:
+                self.child_offsets[p + 1] += 1
+        for i in range(n):
+            self.child_offsets[i + 1] += self.child_offsets[i]
+        self.children = array('l', [0] * self.child_offsets[n])
+        fill = array('l', self.child_offsets[:n])
+        for i, p in enumerate(self.parent):
+            if p >= 0:
+                self.children[fill[p]] = i
+                fill[p] += 1
+        self.roots = [i for i in range(n) if self.parent[i] < 0]
+        # pre-order walk: depth, TOC order and breadcrumbs, each page visited once
+        self.depth = array('l', [0] * n)
+        self.ancestors = [()] * n
+        self.order = array('l')
+        stack = list(reversed(self.roots))
+        while stack:
+            i = stack.pop()
+            self.order.append(i)
+            kids = sorted(self.children[self.child_offsets[i]:self.child_offsets[i + 1]], key=lambda c: self.positions[c])
+            for c in reversed(kids):
+                self.depth[c] = self.depth[i] + 1
+                self.ancestors[c] = self.ancestors[i] + (i,)
+                stack.append(c)
+        self.built = True
+        return(self)
+
+    def page_ancestors(self,arg_i):
+        """Breadcrumb of a page as [{'id', 'title'}], from the root down to its parent."""
+        return([{'id': self.ids[a], 'title': self.titles[a]} for a in self.ancestors[arg_i]])
+
+    def toc_markdown(self):
+        """Table of contents as a nested Markdown list linking to the exported .txt files."""
+        lines = []
+        for i in self.order:
+            lines.append(f"{'  ' * self.depth[i]}- [{self.titles[i]}]({sanitize_filename(self.titles[i])}.txt)")
+        return("\n".join(lines) + "\n")
+
+    def save(self,arg_outdir):
+        """Write _page_index.json (id, parent, depth, ancestors and file per page) and _toc.md into the export folder."""
+        if not self.built:
+            self.build()
+        pages = []
+        for i in self.order:
+            pages.append({
+                'id': self.ids[i],
+                'title': self.titles[i],
+                'parentId': self.ids[self.parent[i]] if self.parent[i] >= 0 else None,
+                'depth': self.depth[i],
+                'ancestors': self.page_ancestors(i),
+                'path': " > ".join([a['title'] for a in self.page_ancestors(i)] + [self.titles[i]]),
+                'file': f"{sanitize_filename(self.titles[i])}.txt",
+            })
+        save_json_file(os.path.join(arg_outdir, "_page_index.json"), {'roots': [self.ids[r] for r in self.roots], 'pages': pages})
+        with open(os.path.join(arg_outdir, "_toc.md"), "w", encoding="utf-8") as f:
+            f.write(self.toc_markdown())
+        print(f"Wrote page index and TOC for {len(self.ids)} pages to {arg_outdir}")
+
+def fetch_page_html(arg_site,arg_page,arg_username,arg_api_token):
+    """Get the export_view HTML of a page from a space listing.
+
+    Uses the export_view body included in the listing record when there is one
+    (see get_pages_from_space arg_body_format) and only fetches it otherwise.
+
+    Args:
+        arg_site: The site name
+        arg_page: Page record from get_pages_from_space (needs 'id' and 'title')
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+
+    Returns:
+        html (str)
+    """
+    my_body_export_view_html = get_inline_body(arg_page)
+    if my_body_export_view_html is None:
+        my_version = (arg_page.get('version') or {}).get('number')
+        my_body_export_view = get_body_export_view(arg_site,arg_page['id'],arg_username,arg_api_token,my_version).json()
+        my_body_export_view_html = my_body_export_view['body']['export_view']['value']
+
+    print(f"\nGetting page {arg_page['title']}, {arg_page['id']}")
+    return(my_body_export_view_html)
+
+def page_section_info(arg_site,arg_page):
+    """URL, version and update time of a listing record, for section_records"""
+    version = arg_page.get('version') or {}
+    webui = (arg_page.get('_links') or {}).get('webui') or f"/pages/viewpage.action?pageId={arg_page['id']}"
+    return({'url': f"https://{arg_site}.atlassian.net/wiki{webui}", 'version': version.get('number'), 'updated': version.get('createdAt') or version.get('when')})
+
+def convert_page(arg_html,arg_title,arg_page_id,arg_outdir,arg_page_parent=None,arg_section_info=None):
+    """Save the HTML of a page as text (and as a JSON record if set_json_output was called).
+
+    Only needs its arguments and the module settings, so it can run in a
+    worker process of export_pages_async.
+
+    Args:
+        arg_section_info: page_section_info of the page, to also split it into section records
+
+    Returns:
+        records (list): section_records of the page when arg_section_info is given, else None
+
+    Raises:
+        RuntimeError: if the text file wasn't written
+    """
+    saved = dump_html(
+        arg_site=None,
+        arg_html=arg_html,
+        arg_title=arg_title,
+        arg_page_id=arg_page_id,
+        arg_outdir_base=arg_outdir,
+        arg_outdir_content=arg_outdir,
+        arg_page_labels=None,
+        arg_page_parent=arg_page_parent,
+        arg_username=None,
+        arg_api_token=None
+    )
+    if not saved:
+        raise RuntimeError(f"could not write the text file for {arg_title}")
+    if arg_section_info is not None:
+        return(section_records(page_sections(arg_html),arg_page_id,arg_title,
+                               arg_section_info['url'],arg_section_info['version'],arg_section_info['updated']))
+
+def _init_convert_process(arg_text_backend,arg_json_dir,arg_json_sharded):
+    """ProcessPoolExecutor initializer: carry the parent's output settings into the worker."""
+    global text_backend, json_output_dir, json_output_sharded
+    text_backend = arg_text_backend
+    json_output_dir = arg_json_dir
+    json_output_sharded = arg_json_sharded
+
+def export_page(arg_site,arg_page,arg_outdir,arg_username,arg_api_token,arg_sections=False):
+    """Save one page from a space listing as text (fetch_page_html + convert_page).
+
+    Args:
+        arg_site: The site name
+        arg_page: Page record from get_pages_from_space (needs 'id', 'title', 'parentId')
+        arg_outdir: Output folder
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_sections: Also return the page's section records
+
+    Returns:
+        records (list): section_records of the page with arg_sections, else None
+    """
+    my_html = fetch_page_html(arg_site,arg_page,arg_username,arg_api_token)
+    my_section_info = page_section_info(arg_site,arg_page) if arg_sections else None
+    return(convert_page(my_html,arg_page['title'],arg_page['id'],arg_outdir,arg_page.get('parentId'),my_section_info))
+
+@dataclass
+class ExportResult:
+    """Outcome of exporting one page, see export_page_by_id."""
+    page_id: str
+    ok: bool = False
+    title: str = None
+    url: str = None
+    version: int = None
+    error: str = None
+    seconds: float = 0.0
+
+def export_page_by_id(arg_site,arg_page_id,arg_outdir,arg_username,arg_api_token,arg_version=None):
+    """Fetch one page by ID (body and version only, see fetch_page_bundle) and save it as text, without raising.
+
+    Args:
+        arg_site: The site name
+        arg_page_id: Page ID
+        arg_outdir: Output folder
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_version: Current version.number of the page if known, lets the response cache skip the request
+
+    Returns:
+        result (ExportResult)
+    """
+    result = ExportResult(page_id=str(arg_page_id), version=arg_version)
+    start = time.perf_counter()
+    try:
+        bundle = fetch_page_bundle(arg_site,arg_page_id,arg_username,arg_api_token,arg_version,PAGE_BODY_EXPAND)
+        result.title = bundle.title
+        result.url = bundle.url
+        result.version = bundle.version if bundle.version is not None else arg_version
+        result.ok = dump_html(
+            arg_site=arg_site,
+            arg_html=bundle.html,
+            arg_title=result.title,
+            arg_page_id=arg_page_id,
+            arg_outdir_base=arg_outdir,
+            arg_outdir_content=arg_outdir,
+            arg_page_labels=None,
+            arg_page_parent=None,
+            arg_username=arg_username,
+            arg_api_token=arg_api_token
+        )
+        if not result.ok:
+            result.error = "could not write the text file"
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    result.seconds = time.perf_counter() - start
+    return(result)
+
+class ExportJournal:
+    """Durable record of the pages an export has finished, for --resume.
+
+    Every finished page is appended as a {"id", "version"} JSON line and
+    fsync'd before the next one, so after a crash the journal lists exactly
+    the pages whose files were completely written. A line cut short by the
+    crash is ignored on load.
+
+    Args:
+        arg_path: Journal file
+        arg_resume: Load the pages already in the journal, otherwise start it over
+    """
+
+    def __init__(self,arg_path,arg_resume=False):
+        self.path = arg_path
+        self.done = {}
+        self.skipped = 0
+        torn = False
+        if arg_resume and os.path.exists(arg_path):
+            with open(arg_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    torn = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.done[entry['id']] = entry.get('version')
+        self.file = open(arg_path, "a" if arg_resume else "w", encoding="utf-8")
+        if torn:
+            self.file.write("\n")      # end the cut line so the next entry isn't glued to it
+        self.lock = threading.Lock()
+
+    def is_done(self,arg_page):
+        """True when the page was finished at the version it has in the listing."""
+        page_id = str(arg_page['id'])
+        return(page_id in self.done and self.done[page_id] == (arg_page.get('version') or {}).get('number'))
+
+    def pending(self,arg_pages):
+        """Pass on the pages that still have to be exported, counting the others in self.skipped."""
+        for page in arg_pages:
+            if self.is_done(page):
+                self.skipped += 1
+                continue
+            yield page
+
+    def record(self,arg_page):
+        page_id = str(arg_page['id'])
+        version = (arg_page.get('version') or {}).get('number')
+        with self.lock:
+            self.file.write(json.dumps({'id': page_id, 'version': version}) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.done[page_id] = version
+
+    def close(self):
+        self.file.close()
+
+def interleave_pages(arg_sources):
+    """Merge several page listings round-robin, one page from each in turn.
+
+    Used to export many spaces through one export_pages run: every space keeps
+    getting a share of the pipeline while it has pages left, so a large space
+    can't hold back the small ones. Each listing is only advanced when its
+    turn comes, so they all keep paginating lazily.
+
+    Args:
+        arg_sources: Iterables of page records (e.g. iter_pages_from_space of each space)
+    """
+    iterators = [iter(source) for source in arg_sources]
+    while iterators:
+        for iterator in list(iterators):
+            page = next(iterator, None)
+            if page is None:
+                iterators.remove(iterator)
+            else:
+                yield page
+
+async def export_pages_async(arg_site,arg_pages,arg_outdir,arg_username,arg_api_token,arg_concurrency=DEFAULT_CONCURRENCY,arg_processes=0,arg_sections_file=None,arg_journal=None,arg_group_key=None):
+    """Export pages concurrently, writing each one as soon as its body arrives.
+
+    The HTTP calls are blocking (requests), so bodies are fetched on worker
+    threads; asyncio only schedules them and caps how many are in flight.
+    arg_pages can be any iterable, including a generator that is still
+    paginating: it is consumed lazily, one record at a time.
+
+    HTML -> text conversion is CPU-bound and holds the GIL, so with
+    arg_processes > 0 it runs in a ProcessPoolExecutor instead: fetchers hand
+    (page, html) to the converters through a bounded queue, and stop fetching
+    while it is full. With arg_processes=0 each fetch thread converts its own
+    page, as before.
+
+    With arg_sections_file, every page is also split into heading sections
+    (page_sections) and their records are appended to that file as JSON
+    lines. Records only come back to the event loop, which is the single
+    writer of the file.
+
+    With arg_journal, every page is recorded in that ExportJournal once its
+    files are written (after its sections).
+
+    With arg_group_key (page -> name, e.g. its space key), each page is
+    written to <arg_outdir>/<name> and stats are also kept per name, with a
+    progress line every PROGRESS_EVERY pages of a group.
+
+    Args:
+        arg_site: The site name
+        arg_pages: Iterable of page records from get_pages_from_space
+        arg_outdir: Output folder
+        arg_username: Username for auth
+        arg_api_token: API token for auth
+        arg_concurrency: Maximum number of pages being fetched
+        arg_processes: Number of conversion processes, 0 to convert on the fetch threads
+        arg_sections_file: Text file open for writing, receives the section records (JSONL)
+        arg_journal: ExportJournal recording the finished pages
+        arg_group_key: Function giving the group of a page record
+
+    Returns:
+        stats (dict): 'exported', 'failed', 'sections' and 'seconds', and with
+            arg_group_key 'groups': name -> 'exported', 'failed', 'seconds'
+    """
+    loop = asyncio.get_running_loop()
+    page_queue = asyncio.Queue(maxsize=arg_concurrency * 2)
+    convert_queue = asyncio.Queue(maxsize=max(arg_processes, 1) * 2)
+    stats = {"exported": 0, "failed": 0, "sections": 0, "seconds": 0.0, "groups": {}}
+    start = time.perf_counter()
+    done = object()         # end-of-queue marker
+    sections = arg_sections_file is not None
+
+    def _outdir(page):
+        if arg_group_key is None:
+            return(arg_outdir)
+        name = arg_group_key(page)
+        if name not in stats['groups']:
+            os.makedirs(os.path.join(arg_outdir, name), exist_ok=True)
+            stats['groups'][name] = {"exported": 0, "failed": 0, "seconds": 0.0, "start": time.perf_counter()}
+        return(os.path.join(arg_outdir, name))
+
+    def _count(page, outcome):
+        stats[outcome] += 1
+        if arg_group_key is None:
+            return
+        name = arg_group_key(page)
+        group = stats['groups'][name]
+        group[outcome] += 1
+        group['seconds'] = time.perf_counter() - group['start']
+        if (group['exported'] + group['failed']) % PROGRESS_EVERY == 0:
+            print(f"  [{name}] {group['exported']} pages exported, {group['failed']} failed, {group['exported'] / max(group['seconds'], 1e-9):.2f} pages/s")
+
+    def _exported(page, records):
+        _count(page, 'exported')
+        if records:
+            arg_sections_file.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+            arg_sections_file.flush()
+            stats['sections'] += len(records)
+        if arg_journal is not None:
+            arg_journal.record(page)
+
+    def _failed(page, e):
+        _count(page, 'failed')
+        print(f"  [!] ERROR exporting {page.get('title')} ({page.get('id')}): {e}")
+
+    async def _producer(executor):
+        iterator = iter(arg_pages)
+        while True:
+            page = await loop.run_in_executor(executor, next, iterator, done)     # a paginating listing may block on HTTP
+            if page is done:
+                break
+            await page_queue.put(page)
+        for _ in range(arg_concurrency):
+            await page_queue.put(done)
+
+    async def _fetcher(executor):
+        while True:
+            page = await page_queue.get()
+            if page is done:
+                return
+            outdir = _outdir(page)
+            try:
+                if not arg_processes:
+                    records = await loop.run_in_executor(executor, export_page, arg_site, page, outdir, arg_username, arg_api_token, sections)
+                    _exported(page, records)
+                    continue
+                html = await loop.run_in_executor(executor, fetch_page_html, arg_site, page, arg_username, arg_api_token)
+            except Exception as e:
+                _failed(page, e)
+                continue
+            await convert_queue.put((page, html))
+
+    async def _converter(processes):
+        while True:
+            item = await convert_queue.get()
+            if item is done:
+                return
+            page, html = item
+            try:
+                records = await loop.run_in_executor(processes, convert_page, html, page['title'], page['id'], _outdir(page), page.get('parentId'),
+                                                     page_section_info(arg_site, page) if sections else None)
+            except Exception as e:
+                _failed(page, e)
+            else:
+                _exported(page, records)
+
+    with ThreadPoolExecutor(max_workers=arg_concurrency + 1) as executor:      # +1 for the producer
+        if not arg_processes:
+            await asyncio.gather(_producer(executor), *(_fetcher(executor) for _ in range(arg_concurrency)))
+        else:
+            with ProcessPoolExecutor(max_workers=arg_processes, initializer=_init_convert_process,
+                                     initargs=(text_backend, json_output_dir, json_output_sharded)) as processes:
+                converters = [asyncio.ensure_future(_converter(processes)) for _ in range(arg_processes)]
+                await asyncio.gather(_producer(executor), *(_fetcher(executor) for _ in range(arg_concurrency)))
+                for _ in range(arg_processes):
+                    await convert_queue.put(done)
+                await asyncio.gather(*converters)
+
+    stats['seconds'] = time.perf_counter() - start
+    for group in stats['groups'].values():
+        del group['start']
+    return(stats)
+
+def export_pages(arg_site,arg_pages,arg_outdir,arg_username,arg_api_token,arg_concurrency=DEFAULT_CONCURRENCY,arg_processes=0,arg_sections_file=None,arg_journal=None,arg_group_key=None):
+    """Run export_pages_async from synchronous code and print the throughput."""
+    stats = asyncio.run(export_pages_async(arg_site,arg_pages,arg_outdir,arg_username,arg_api_token,arg_concurrency,arg_processes,arg_sections_file,arg_journal,arg_group_key))
+    for name, group in sorted(stats['groups'].items()):
+        rate = group['exported'] / group['seconds'] if group['seconds'] > 0 else 0.0
+        print(f"  {name}: {group['exported']} pages in {group['seconds']:.1f}s ({rate:.2f} pages/s), {group['failed']} failed")
+    rate = stats['exported'] / stats['seconds'] if stats['seconds'] > 0 else 0.0
+    print(f"Exported {stats['exported']} pages in {stats['seconds']:.1f}s ({rate:.2f} pages/s), {stats['failed']} failed")
+    if arg_sections_file is not None:
+        print(f"Wrote {stats['sections']} sections")
+    return(stats)
@@ -1,17 +1,24 @@
 """Clean and preprocess text documents from Confluence and save as JSON files."""
 
 import json
+import os
 import re
+import threading
+import time
 from pathlib import Path
 from bs4 import BeautifulSoup
 
-def clean_text(text: str) -> str:
-    """Remove HTML, URLs, normalize whitespace, and strip text."""
-    text = BeautifulSoup(text, "html.parser").get_text()
+def normalize_text(text: str) -> str:
+    """Remove URLs, normalize whitespace, and strip text that has no HTML left in it."""
     text = re.sub(r'https?://\S+', '', text)  # remove URLs
     text = re.sub(r'\s+', ' ', text)  # normalize whitespace
     return text.strip()
 
+def clean_text(text: str) -> str:
+    """Remove HTML, URLs, normalize whitespace, and strip text."""
+    text = BeautifulSoup(text, "html.parser").get_text()
+    return normalize_text(text)
+
 def extract_date_from_filename(filename: str) -> str:
     """Try to extract a date in format YYYY.MM.DD from filename."""
     match = re.search(r'(\d{4}\.\d{2}\.\d{2})', filename)
@@ -25,37 +32,193 @@ def generate_brief(text: str, max_words: int = 30) -> str:
         brief += '...'
     return brief
 
-def process_all_files(input_dir: str, output_dir: str):
+def build_record(cleaned_content: str, file_path) -> dict:
+    """Create the JSON record of one document from its cleaned text and .txt path."""
+    file_path = Path(file_path)
+    return {
+        "source": str(file_path),
+        "date": extract_date_from_filename(file_path.name),
+        "name": file_path.stem,
+        "content": cleaned_content,
+        "brief": generate_brief(cleaned_content)
+    }
+
+def save_record(result: dict, output_dir) -> Path:
+    """Save a record as <output_dir>/<name>.json (atomically) and return its path."""
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_file = output_dir / f"{result['name']}.json"
+    tmp_file = output_file.with_name(f"{output_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, output_file)   # a crash never leaves a truncated record behind
+    return output_file
+
+SHARD_MAX_BYTES = 64 * 1024 * 1024
+
+class ShardStore:
+    """Records appended to size-capped JSONL shards, with a sidecar offset index.
+
+    Every writer (one per process) appends to its own shard-<writer>-NNNNN.jsonl
+    files and logs "[key, seq, shard, offset, length]" lines to its own
+    index-<writer>.jsonl, so several export processes can write to the same
+    folder without locking each other. Reading replays all index files and
+    keeps the entry with the highest seq for each key, which makes get() one
+    seek and one read. A key written again only supersedes the old record in
+    the index; compact() rewrites the live records and drops the rest.
+    """
+
+    def __init__(self, root, max_shard_bytes: int = SHARD_MAX_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_shard_bytes = max_shard_bytes
+        self.writer = f"{os.getpid()}-{time.time_ns()}"
+        self.index = None           # key -> (seq, shard, offset, length), loaded on first read
+        self.lock = threading.Lock()
+        self._shard = None
+        self._shard_no = -1
+        self._index_file = None
+
+    def _load_index(self) -> dict:
+        index = {}
+        for index_path in sorted(self.root.glob("index-*.jsonl")):
+            with open(index_path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        key, seq, shard, offset, length = json.loads(line)
+                    except ValueError:
+                        continue            # line cut short by a crash, its record is ignored
+                    if key not in index or seq > index[key][0]:
+                        index[key] = (seq, shard, offset, length)
+        return index
+
+    def _entries(self) -> dict:
+        with self.lock:
+            if self.index is None:
+                self.index = self._load_index()
+            return self.index
+
+    def _roll(self, size: int):
+        if self._shard is not None and self._shard.tell() + size <= self.max_shard_bytes:
+            return
+        if self._shard is not None:
+            self._shard.close()
+        self._shard_no += 1
+        self._shard = open(self.root / f"shard-{self.writer}-{self._shard_no:05d}.jsonl", "ab")
+        if self._index_file is None:
+            self._index_file = open(self.root / f"index-{self.writer}.jsonl", "a", encoding="utf-8")
+
+    def put(self, key: str, record: dict):
+        """Append a record, superseding any earlier record with the same key."""
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        with self.lock:
+            self._roll(len(data))
+            offset = self._shard.tell()
+            self._shard.write(data)
+            self._shard.flush()
+            entry = (time.time_ns(), Path(self._shard.name).name, offset, len(data))
+            self._index_file.write(json.dumps([key, *entry]) + "\n")
+            self._index_file.flush()
+            if self.index is not None:
+                self.index[key] = entry
+
+    def _read(self, entry) -> dict:
+        _, shard, offset, length = entry
+        with open(self.root / shard, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def get(self, key: str):
+        """Return the latest record stored under key, or None."""
+        entry = self._entries().get(key)
+        return None if entry is None else self._read(entry)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries()
+
+    def __len__(self) -> int:
+        return len(self._entries())
+
+    def records(self):
+        """Yield (key, record) for every live record, in shard order."""
+        for key, entry in sorted(self._entries().items(), key=lambda item: item[1][1:3]):
+            yield key, self._read(entry)
+
+    def close(self):
+        with self.lock:
+            for f in (self._shard, self._index_file):
+                if f is not None:
+                    f.close()
+            self._shard = self._index_file = None
+
+    def compact(self) -> dict:
+        """Rewrite the live records into new shards and delete everything else.
+
+        Must not run while other processes are writing to the folder. The new
+        index is renamed into place before old files are removed, so a crash
+        at any point leaves either the old or the new records readable.
+        """
+        self.close()
+        entries = self._entries()
+        old_files = [p for p in self.root.iterdir() if p.name.startswith(("shard-", "index-"))]
+        bytes_before = sum(p.stat().st_size for p in old_files if p.name.startswith("shard-"))
+        compacted = ShardStore(self.root, self.max_shard_bytes)
+        compacted.writer = f"compact-{time.time_ns()}"
+        new_index = {}
+        for key, record in self.records():
+            data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+            compacted._roll(len(data))
+            offset = compacted._shard.tell()
+            compacted._shard.write(data)
+            new_index[key] = (time.time_ns(), Path(compacted._shard.name).name, offset, len(data))
+        if compacted._shard is not None:
+            compacted._shard.close()
+            compacted._index_file.close()
+        index_path = self.root / f"index-{compacted.writer}.jsonl"
+        tmp_path = index_path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps([key, *entry]) + "\n" for key, entry in new_index.items())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, index_path)
+        for p in old_files:
+            if p != index_path:
+                p.unlink()
+        with self.lock:
+            self.index = new_index
+        bytes_after = sum(p.stat().st_size for p in self.root.glob("shard-*.jsonl"))
+        return {"records": len(new_index), "bytes_before": bytes_before, "bytes_after": bytes_after}
+
+def process_all_files(input_dir: str, output_dir: str, sharded: bool = False):
+    """Clean every .txt under input_dir into a JSON record, one file each or into a ShardStore."""
     input_dir = Path(input_dir)
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
+    store = ShardStore(output_dir) if sharded else None
 
     for file_path in input_dir.rglob("*.txt"):
         try:
             with open(file_path, encoding="utf-8", errors="ignore") as f:
                 raw_text = f.read()
 
-            cleaned_content = clean_text(raw_text)
-            file_date = extract_date_from_filename(file_path.name)
-            file_name = file_path.stem
+            result = build_record(clean_text(raw_text), file_path)
 
-            result = {
-                "source": str(file_path),
-                "date": file_date,
-                "name": file_name,
-                "content": cleaned_content,
-                "brief": generate_brief(cleaned_content)
-            }
+            if store is not None:
+                store.put(result["name"], result)
+                print(f"✅ Processed {file_path.name} → {output_dir.name} shards")
+                continue
 
             # Save each file as its own JSON
-            output_file = output_dir / f"{file_name}.json"
-            with open(output_file, "w", encoding="utf-8") as f:
-                json.dump(result, f, indent=2, ensure_ascii=False)
+            output_file = save_record(result, output_dir)
 
             print(f"✅ Processed {file_path.name} → {output_file.name}")
 
         except Exception as e:
             print(f"❌ Failed to process {file_path.name}: {e}")
+    if store is not None:
+        store.close()
 
 if __name__ == "__main__":
     process_all_files(